@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from pool import Response
+
+
+def parse_cache_control(value: str) -> dict:
+    """
+    Parse a Cache-Control header into its directives
+
+    :param value:       The value of the header
+    :return:            A dictionary of lower-cased directive names to their value, None for directives without one
+    """
+    directives = dict()
+    for item in value.split(','):
+        name, _, argument = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def fresh_until(headers: dict, now: float) -> (float, bool):
+    """
+    Work out until when a response may be reused without asking the server, from Cache-Control and Expires
+
+    :param headers:     The headers of the response
+    :param now:         The time the response was received
+    :return:            A tuple of the time the response stops being fresh and whether it may be stored at all
+    """
+    directives = parse_cache_control(headers.get('Cache-Control', ''))
+    if 'no-store' in directives:
+        return 0.0, False
+    if 'no-cache' in directives:
+        return 0.0, True  # Stored, but revalidated before every use
+    if directives.get('max-age', '').isdigit():
+        age = headers.get('Age', '0')
+        return now + int(directives['max-age']) - (int(age) if age.isdigit() else 0), True
+    if 'Expires' in headers:
+        try:
+            return parsedate_to_datetime(headers['Expires']).timestamp(), True
+        except (TypeError, ValueError):
+            return 0.0, True  # An invalid date means already expired
+    return 0.0, True
+
+
+class CacheEntry(object):
+    """
+    The metadata of a cached response, its body is stored in a file named after the key
+    """
+
+    def __init__(self, url: str, headers: dict, size: int, expires: float):
+        self.url = url
+        self.headers = headers
+        self.size = size  # Number of bytes of the stored body
+        self.expires = expires  # Time until which the entry is used without revalidation
+
+    def validators(self) -> dict:
+        """
+        :return:            The conditional request headers revalidating this entry
+        """
+        conditions = dict()
+        if 'ETag' in self.headers:
+            conditions['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            conditions['If-Modified-Since'] = self.headers['Last-Modified']
+        return conditions
+
+
+_OWN_FILE = re.compile(r'[0-9a-f]{40}(\.part\.\d+)?|index\.json\.tmp')  # Bodies, partial bodies, unwritten index
+
+
+class HttpCache(object):
+    """
+    Persistent cache of GET responses keyed by URL, with conditional revalidation and LRU eviction by size
+    """
+    INDEX = 'index.json'
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param directory:   Directory to store the bodies and the index in, created if it does not exist
+        :param max_bytes:   Total number of body bytes the cache may hold
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0  # Number of body bytes currently stored
+        self.hits = 0  # Responses served without asking the server
+        self.revalidations = 0  # Responses served from the cache after a 304
+        self._entries = OrderedDict()  # Key -> CacheEntry, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """
+        Read the index written by the previous run and remove the bodies and temporary files it does not know about
+        """
+        try:
+            with open(os.path.join(self.directory, self.INDEX)) as f:
+                for key, item in json.load(f):
+                    self._entries[key] = CacheEntry(item['url'], item['headers'], item['size'], item['expires'])
+        except (OSError, ValueError, KeyError, TypeError):
+            self._entries.clear()  # Start over from an empty cache
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if _OWN_FILE.fullmatch(name) and name not in self._entries and os.path.isfile(path):
+                os.remove(path)  # Only files this cache writes, the directory may hold other files
+        for key in list(self._entries):
+            if not os.path.exists(self._path(key)):
+                del self._entries[key]
+        self.size = sum(entry.size for entry in self._entries.values())
+
+    def close(self):
+        """
+        Write the index so the next run can reuse the stored responses
+        """
+        with self._lock:
+            items = [(key, entry.__dict__) for key, entry in self._entries.items()]
+        temp_path = os.path.join(self.directory, self.INDEX + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(items, f)
+        os.replace(temp_path, os.path.join(self.directory, self.INDEX))
+
+    @staticmethod
+    def key(host: str, port: int, target: str) -> str:
+        return hashlib.sha1('http://{h}:{p}{t}'.format(h=host, p=port, t=target).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def request(self, send, host: str, port: int, target: str, headers: dict = None, sink=None):
+        """
+        Serve a GET request from the cache if the stored response is fresh, otherwise revalidate it
+        with If-None-Match/If-Modified-Since and store what the server sends
+
+        :param send:        Function of the request headers and sink sending the request, e.g. a partial of
+                            ConnectionPool._request
+        :param host:        The host of the request
+        :param port:        The port of the host
+        :param target:      The request target
+        :param headers:     Extra request headers
+        :param sink:        File-like object to stream the body to, or a function of the response headers returning one
+        :return:            The response
+        """
+        key = self.key(host, port, target)
+        url = 'http://{h}:{p}{t}'.format(h=host, p=port, t=target)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        headers = dict(headers or {})
+        if entry is not None:
+            if time.time() < entry.expires:
+                response = self._replay(key, entry, sink)
+                if response is not None:
+                    self.hits += 1
+                    return response
+            headers.update(entry.validators())
+
+        store = _StoringSink(self._path(key) + '.part', sink)
+        try:
+            response = send(headers, store.start)
+        except Exception:
+            store.abort()
+            raise
+        if response.status == 304 and entry is not None:
+            store.abort()
+            entry.expires, _ = fresh_until(response.headers, time.time())
+            entry.headers.update({name: value for name, value in response.headers.items()
+                                  if name in ('Cache-Control', 'Expires', 'ETag', 'Last-Modified')})
+            replayed = self._replay(key, entry, sink)
+            if replayed is not None:
+                self.revalidations += 1
+                return replayed
+            # The body disappeared in the meantime, fetch it again without conditions
+            return self.request(send, host, port, target, {k: v for k, v in headers.items()
+                                                           if k not in ('If-None-Match', 'If-Modified-Since')}, sink)
+        if sink is None and store.body is not None:
+            response.body = store.body  # The pool wrote the body to the storing sink
+        expires, storable = fresh_until(response.headers, time.time())
+        if response.status != 200 or not storable or store.size > self.max_bytes or store.file is None:
+            store.abort()
+            return response
+        store.finish(self._path(key))
+        stored_headers = {name: value for name, value in response.headers.items()
+                          if name not in ('Content-Encoding', 'Transfer-Encoding', 'Content-Length')}
+        self._store(key, CacheEntry(url, stored_headers, store.size, expires))
+        return response
+
+    def _replay(self, key: str, entry: CacheEntry, sink):
+        """
+        Build a response from a stored body
+
+        :param key:         The key of the entry
+        :param entry:       The entry
+        :param sink:        File-like object to copy the body to, or a function of the headers returning one
+        :return:            The response, or None if the body is gone
+        """
+        try:
+            body_file = open(self._path(key), 'rb')
+        except OSError:
+            self._remove(key)
+            return None
+        with body_file:
+            if callable(sink):
+                sink = sink(entry.headers)
+            if sink is None:
+                body = bytearray(body_file.read())
+            else:
+                body = bytearray()
+                shutil.copyfileobj(body_file, sink)
+        return Response(200, 'OK', dict(entry.headers), body, entry.size)
+
+    def _store(self, key: str, entry: CacheEntry):
+        """
+        Add an entry and evict the least recently used entries until the cache fits in max_bytes
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                try:
+                    os.remove(self._path(evicted_key))
+                except OSError:
+                    pass
+
+    def _remove(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+
+class _StoringSink(object):
+    """
+    Writes a body to a temporary cache file while passing it on to the sink of the caller
+    """
+
+    def __init__(self, temp_path: str, sink):
+        self.temp_path = temp_path
+        self.sink = sink
+        self.body = bytearray() if sink is None else None  # Kept in memory when the caller did not pass a sink
+        self.file = None
+        self.size = 0
+
+    def start(self, headers: dict) -> '_StoringSink':
+        """
+        Called by the pool with the response headers, before the body arrives
+
+        :param headers:     The headers of the response
+        :return:            This object, to write the body to
+        """
+        if callable(self.sink):
+            self.sink = self.sink(headers)
+        if self.file is None:
+            self.file = open(self.temp_path + '.{t}'.format(t=threading.get_ident()), 'wb')
+        return self
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        if self.body is not None:
+            self.body += data
+        else:
+            self.sink.write(data)
+
+    def finish(self, path: str):
+        self.file.close()
+        os.replace(self.file.name, path)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.file.name)
+            self.file = None
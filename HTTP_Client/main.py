@@ -1,9 +1,21 @@
+import codecs
+import html
+import mimetypes
+import re
 import sys
 import socket
 import os
 from bs4 import BeautifulSoup
 import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
 from func import parse_headers
+from http_cache import HttpCache
+from pool import ACCEPT_ENCODING, ConnectionPool
+from tracing import TRACER
 
 
 def create_new_socket() -> socket.socket:
@@ -16,17 +28,6 @@ def create_new_socket() -> socket.socket:
     return s
 
 
-def connect_socket(s: socket.socket, host: str, port: int):
-    """
-    Connect to a host on a socket
-
-    :param s:           The socket on which to connect to the host
-    :param host:        The host to connect to
-    :param port:        The port to connect on
-    """
-    s.connect((host, port))
-
-
 def get_encoding(headers: dict, response: str) -> str:
     """
     Parse the encoding from the headers or an HTTP response
@@ -35,14 +36,16 @@ def get_encoding(headers: dict, response: str) -> str:
     :param response:    An HTTP response
     :return:            The charset used for encoding
     """
-    if 'charset=' in headers['Content-Type']:
+    if 'charset=' in headers.get('Content-Type', ''):
         charset = headers['Content-Type'].rsplit('charset=', 1)[1].lower()
         return charset
     else:
         index = response.find('charset=')
-        outdex = response.find('"', index)
-        charset = response[index + 8:outdex]
-        return charset
+        if index < 0:
+            return 'utf-8'  # Neither the headers nor the page declare a charset
+        # Accept both <meta charset="x"> and <meta content="text/html; charset=x">
+        charset = re.match(r'[\'"]?([\w.:-]*)', response[index + 8:]).group(1).lower()
+        return charset or 'utf-8'
 
 
 def is_chunk_based(headers: dict) -> bool:
@@ -58,46 +61,6 @@ def is_chunk_based(headers: dict) -> bool:
     return False
 
 
-def read_and_decode(s: socket.socket, no_bytes: int, encoding: str) -> str:
-    """
-    Reads the specified number of bytes on the socket and
-    decodes them using the given encoding
-
-    :param s:           The socket on which to read
-    :param no_bytes:    The number of bytes to read
-    :param encoding:    The encoding in which the bytes should be decoded
-    :return:            The decoded text
-    """
-    body = s.recv(no_bytes).decode(encoding=encoding)
-    length = len(body)
-    no_bytes -= length
-    if no_bytes <= 0:
-        return body.strip('\r\n')
-    else:
-        while no_bytes > 0:
-            new_text = s.recv(no_bytes).decode(encoding=encoding)
-            body += new_text
-            no_bytes -= len(new_text)
-        return body
-
-
-def get_new_chunk_length(s: socket.socket, encoding: str) -> (int, str):
-    """
-    Check how many bytes the next chunk has and return the extra of the body
-
-    :param s:           The socket on which to read
-    :param encoding:    The encoding in which the bytes should be decoded
-    :return:            A tuple of the bytes in the next chunk and the extra body
-    """
-    b = s.recv(6).decode(encoding=encoding)
-    a = b.split('\r\n')
-    next_length = int(a[0], 16)
-    if next_length == 0:
-        return 0, ''
-    else:
-        return next_length - len(a[1]), a[1]
-
-
 def is_image_local(src: str, host: str) -> bool:
     if ('http://' in src) or ('https://' in src):
         if host in src:
@@ -108,112 +71,592 @@ def is_image_local(src: str, host: str) -> bool:
         return True
 
 
-def create_dirs(rel_path: str, path: str) -> str:
+def create_dirs(rel_path: list, path: str) -> str:
     new_path = path
     for p in rel_path:
         p = p.replace('%20', ' ')
-        new_path = os.path.join(new_path, p + '\\')
-        if os.path.exists(new_path):
-            pass
-        else:
-            os.mkdir(new_path)
-    return new_path
+        new_path = os.path.join(new_path, p)
+        os.makedirs(new_path, exist_ok=True)  # Pages crawled in parallel may create the same directory
+    return new_path + os.sep
 
 
-def fetch_local_image(src: str, host: str, port: int):
-    img = b''
-    request = 'GET /' + src + ' HTTP/1.1\r\nHost: ' + host + '\r\n' + 'Connection: keep-alive\r\n' + '\r\n'
-    # Doesn't seem to work without new socket, could not find my mistake
-    s = create_new_socket()
-    connect_socket(s, host, port)
-    s.send(request.encode())
-    while True:
-        data = s.recv(4096)
-        if data == b'':
-            break
-        elif b'\x00IEND\xaeB`\x82' in data:
-            img = img + data
-            break
-        else:
-            img = img + data
-    pos = img.find(b'\r\n\r\n')
-    return img[pos + 4:]
+def download_image(src: str, host: str, port: int, pool: ConnectionPool, file_path: str) -> int:
+    """
+    Stream an image from the host of the page straight to a file, without holding it in memory
 
+    :param src:         The path of the image on the host, without leading slash
+    :param host:        The host of the page
+    :param port:        The port to connect on
+    :param pool:        The connection pool to send the request over
+    :param file_path:   The file to write the image to
+    :return:            The number of bytes written
+    """
+    try:
+        with open(file_path, 'wb') as img_file:
+            return pool.request(host, port, 'GET', '/' + src, sink=img_file).length
+    except Exception:
+        os.remove(file_path)  # Do not leave a truncated image behind
+        raise
 
-def save_local_image(path, name, data, img_element, src):
-    img_file = open(path + name, 'wb')
-    img_file.write(data)
-    img_file.close()
-    img_element['src'] = './' + src
 
+def fetch_external_image(src: str, host: str, port: int, pool: ConnectionPool) -> bytes:
+    """
+    Fetch an image from another host over a pooled connection
 
-def fetch_external_image(src: str, host: str, port: int):
-    img = b''
-    request = 'GET /' + src + ' HTTP/1.1\r\nHost: ' + host + '\r\n' + 'Connection: keep-alive\r\n' + '\r\n'
-    # Doesn't seem to work without new socket, could not find my mistake
-    s = create_new_socket()
-    connect_socket(s, host, port)
-    s.send(request.encode())
-    while True:
-        data = s.recv(4096)
-        if data == b'':
-            break
-        elif b'\x00IEND\xaeB`\x82' in data:
-            img = img + data
-            break
-        else:
-            img = img + data
-    pos = img.find(b'\r\n\r\n')
-    return img[pos + 4:]
+    :param src:         The path of the image on the host, without leading slash
+    :param host:        The host of the image
+    :param port:        The port to connect on
+    :param pool:        The connection pool to send the request over
+    :return:            The image data
+    """
+    return pool.request(host, port, 'GET', '/' + src).body
 
 
-def save_body(body: str, host: str, s: socket.socket, port: int):
+def save_body(body: str, host: str, pool: ConnectionPool, port: int, workers: int = 1, per_host: int = 4,
+              pipeline: int = 0):
     """
     Save the body to index.html and get the included images
 
     :param body:
     :param host:
-    :param s:
+    :param pool:        The connection pool to fetch the images over
     :param port:
+    :param workers:     The number of images fetched at the same time
+    :param per_host:    The maximum number of images fetched at the same time from a single host
+    :param pipeline:    The number of pipelined requests in flight for the local images, 0 to not pipeline them
     """
     url = host[4:]
-    soup = BeautifulSoup(body, 'html.parser')
+    with TRACER.span('parse_html'):
+        soup = BeautifulSoup(body, 'html.parser')
     parent_dir = os.getcwd()
     path = os.path.join(parent_dir, url)
     if os.path.exists(path):
         shutil.rmtree(path)
     os.mkdir(path)
-    get_images(soup, s, path, host, port)
-    html_file = open("./" + url + "/index.html", 'w')
-    html_file.write(soup.prettify())
-    html_file.close()
-
-
-def get_images(soup: BeautifulSoup, s: socket.socket, path: str, host: str, port: int):
-    images = soup.find_all('img')
-    for image in images:
-        src = image.get('src')
-        if is_image_local(src, host):
-            if src[0] == '/':
-                src = src[1:]
-            rel_path, file_name = src.rsplit('/')[0:-1], src.rsplit('/')[-1]
-            if len(rel_path) == 0:
-                new_path = path + '\\'
+    with TRACER.span('get_images'):
+        get_images(soup, pool, path, host, port, workers, per_host, pipeline)
+    with TRACER.span('write_html'):
+        html_file = open("./" + url + "/index.html", 'w')
+        html_file.write(soup.prettify())
+        html_file.close()
+
+
+def timed_fetch(fetch, limit: threading.Semaphore, *args) -> (object, float):
+    """
+    Fetch an image while holding a slot of its host and measure how long it took
+
+    :param fetch:       download_image or fetch_external_image
+    :param limit:       The semaphore limiting the concurrent fetches from the host
+    :param args:        The arguments of the fetch function
+    :return:            A tuple of the result of the fetch and the seconds it took
+    """
+    with limit:
+        start = time.perf_counter()
+        with TRACER.span('fetch_image', args[0]):
+            result = fetch(*args)
+        return result, time.perf_counter() - start
+
+
+def prepare_local_image(src: str, path: str) -> (str, str):
+    """
+    Create the directories a local image is saved in
+
+    :param src:         The src attribute of the image
+    :param path:        The directory the page is saved in
+    :return:            A tuple of the path of the image on the host, without leading slash, and the file to save
+                        it to
+    """
+    if src[0] == '/':
+        src = src[1:]
+    rel_path, file_name = src.rsplit('/')[0:-1], src.rsplit('/')[-1]
+    if len(rel_path) == 0:
+        new_path = path + os.sep
+    else:
+        new_path = create_dirs(rel_path, path)  # Created up front so the fetches only do network I/O
+    return src, new_path + file_name
+
+
+def pipeline_images(pool: ConnectionPool, host: str, port: int, images: list, depth: int) -> list:
+    """
+    Save the local images of a page over a single pipelined connection instead of one request at a time
+
+    :param pool:        The connection pool to fetch the images over
+    :param host:        The host of the page
+    :param port:        The port to connect on
+    :param images:      A list of (src, file path) tuples, see prepare_local_image
+    :param depth:       The maximum number of requests sent before their responses are read
+    :return:            A list of (src, bytes, seconds) tuples, the seconds counting until the image started arriving
+    """
+    files = []
+    arrived = dict()
+    start = time.perf_counter()
+
+    def sink(src: str, file_path: str):
+        def open_file(headers: dict):
+            arrived[src] = time.perf_counter() - start
+            files.append(open(file_path, 'wb'))
+            return files[-1]
+        return open_file
+
+    try:
+        with TRACER.span('pipeline_images'):
+            responses = pool.pipeline(host, port, ['/' + src for src, _ in images],
+                                      [sink(src, file_path) for src, file_path in images], depth=depth)
+    except Exception:
+        for img_file in files:
+            img_file.close()
+            os.remove(img_file.name)  # Do not leave truncated images behind
+        raise
+    finally:
+        for img_file in files:
+            img_file.close()
+    timings = []
+    for (src, _), response in zip(images, responses):
+        timings.append((src, response.length, arrived[src]))
+        print('Fetched {name} ({size} bytes) after {ms:.1f} ms'.format(name=src, size=response.length,
+                                                                       ms=arrived[src] * 1000))
+    return timings
+
+
+def submit_image(executor: ThreadPoolExecutor, limits: dict, src: str, pool: ConnectionPool, path: str, host: str,
+                 port: int, per_host: int) -> (Future, str, str):
+    """
+    Start fetching an image of the page, creating the directories of a local image first
+
+    :param executor:    The executor running the fetches
+    :param limits:      Host -> semaphore bounding the concurrent fetches from it, shared by all images of the page
+    :param src:         The src attribute of the image
+    :param pool:        The connection pool to fetch the image over
+    :param path:        The directory the page is saved in
+    :param host:        The host of the page
+    :param port:        The port to connect on
+    :param per_host:    The maximum number of images fetched at the same time from a single host
+    :return:            A tuple of the future of the fetch, the name to report it under and the src pointing to
+                        the saved copy, which is None for external images as they are not saved
+    """
+    if is_image_local(src, host):
+        src, file_path = prepare_local_image(src, path)
+        limit = limits.setdefault(host, threading.Semaphore(per_host))
+        future = executor.submit(timed_fetch, download_image, limit, src, host, port, pool, file_path)
+        return future, src, './' + src
+    full_url = src
+    if 'https://' in full_url:
+        full_url = full_url[8:]
+    else:
+        full_url = full_url[7:]
+    if full_url[0:4] != 'www.':
+        full_url = 'www.' + full_url
+    image_host, src = full_url.split('/')[0], full_url.split('/')[1:]
+    filter(None, src)
+    limit = limits.setdefault(image_host, threading.Semaphore(per_host))
+    future = executor.submit(timed_fetch, fetch_external_image, limit, ''.join(src), image_host, port, pool)
+    return future, full_url, None
+
+
+def collect_images(jobs: list) -> list:
+    """
+    Wait for the image fetches and report how long each took
+
+    :param jobs:        A list of (future, name) tuples, in document order
+    :return:            A list of (name, bytes, seconds) tuples with the timing of every image
+    """
+    timings = []
+    for future, name in jobs:
+        result, seconds = future.result()
+        size = result if isinstance(result, int) else len(result)  # Saved images report their size
+        timings.append((name, size, seconds))
+        print('Fetched {name} ({size} bytes) in {ms:.1f} ms'.format(name=name, size=size, ms=seconds * 1000))
+    return timings
+
+
+def get_images(soup: BeautifulSoup, pool: ConnectionPool, path: str, host: str, port: int, workers: int = 1,
+               per_host: int = 4, pipeline: int = 0) -> list:
+    """
+    Fetch the images of the page, save the local ones and point their src to the saved copy
+
+    :param soup:        The parsed page
+    :param pool:        The connection pool to fetch the images over
+    :param path:        The directory the page is saved in
+    :param host:        The host of the page
+    :param port:        The port to connect on
+    :param workers:     The number of images fetched at the same time
+    :param per_host:    The maximum number of images fetched at the same time from a single host
+    :param pipeline:    If above 0, the local images are fetched over one connection with up to this many requests
+                        in flight, while the external ones are fetched by the workers
+    :return:            A list of (src, bytes, seconds) tuples with the timing of every image
+    """
+    limits = dict()
+    jobs = []
+    local_images = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for image in soup.find_all('img'):
+            src = image.get('src')
+            if pipeline > 0 and is_image_local(src, host):
+                local_images.append(prepare_local_image(src, path))
+                image['src'] = './' + local_images[-1][0]  # Point to the saved copy
+                continue
+            future, name, saved_src = submit_image(executor, limits, src, pool, path, host, port, per_host)
+            jobs.append((future, name))
+            if saved_src is not None:
+                image['src'] = saved_src  # Point to the saved copy
+        timings = pipeline_images(pool, host, port, local_images, pipeline) if local_images else []
+        return timings + collect_images(jobs)
+
+
+class StreamingPage(HTMLParser):
+    """
+    Writes a page to a file while it is being received, rewriting the src of local images and starting
+    their fetch as soon as each <img> tag is parsed
+    """
+
+    def __init__(self, html_file, submit):
+        """
+        :param html_file:   The text file to write the page to
+        :param submit:      Function starting the fetch of an image src and returning the src to write instead
+        """
+        super().__init__(convert_charrefs=False)  # Keep character references as they were sent
+        self.html_file = html_file
+        self.submit = submit
+        self.response_headers = dict()
+        self._pending = bytearray()  # Bytes received before the charset is known
+        self._decoder = None
+
+    def start(self, headers: dict) -> 'StreamingPage':
+        """
+        Start receiving a response, used as the sink factory of ConnectionPool.request
+
+        :param headers:     The headers of the response
+        :return:            This page, which receives the body through write()
+        """
+        self.response_headers = headers
+        return self
+
+    def write(self, data: bytes):
+        """
+        Decode and parse the next bytes of the page
+
+        :param data:        The received bytes
+        """
+        if self._decoder is not None:
+            self.feed(self._decoder.decode(data))
+            return
+        self._pending += data
+        if len(self._pending) >= 1024:  # The charset has to be declared within the first 1024 bytes
+            self._start_decoding()
+
+    def _start_decoding(self):
+        encoding = get_encoding(self.response_headers, self._pending[:1024].decode('latin-1'))
+        try:
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        except LookupError:
+            self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending, self._pending = self._pending, bytearray()
+        self.feed(self._decoder.decode(pending))
+
+    def close(self):
+        if self._decoder is None:
+            self._start_decoding()
+        self.feed(self._decoder.decode(b'', final=True))
+        super().close()
+
+    def _img_tag(self, attrs: list, end: str) -> str:
+        src = dict(attrs).get('src')
+        new_src = self.submit(src) if src else None
+        if new_src is None:
+            return self.get_starttag_text()
+        tag = '<img'
+        for key, value in attrs:
+            if key == 'src':
+                value = new_src
+            tag += ' ' + key if value is None else ' {key}="{value}"'.format(key=key, value=html.escape(value))
+        return tag + end
+
+    def handle_starttag(self, tag, attrs):
+        self.html_file.write(self._img_tag(attrs, '>') if tag == 'img' else self.get_starttag_text())
+
+    def handle_startendtag(self, tag, attrs):
+        self.html_file.write(self._img_tag(attrs, ' />') if tag == 'img' else self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        self.html_file.write('</' + tag + '>')
+
+    def handle_data(self, data):
+        self.html_file.write(data)
+
+    def handle_entityref(self, name):
+        self.html_file.write('&' + name + ';')
+
+    def handle_charref(self, name):
+        self.html_file.write('&#' + name + ';')
+
+    def handle_comment(self, data):
+        self.html_file.write('<!--' + data + '-->')
+
+    def handle_decl(self, decl):
+        self.html_file.write('<!' + decl + '>')
+
+    def handle_pi(self, data):
+        self.html_file.write('<?' + data + '>')
+
+    def unknown_decl(self, data):
+        self.html_file.write('<![' + data + ']>')
+
+
+def stream_body(host: str, pool: ConnectionPool, port: int, workers: int = 1, per_host: int = 4) -> list:
+    """
+    Get the page and write it to index.html while it arrives, fetching its images as soon as they are seen.
+    Unlike save_body the page is written as received instead of prettified.
+
+    :param host:        The host of the page
+    :param pool:        The connection pool to fetch the page and images over
+    :param port:        The port to connect on
+    :param workers:     The number of images fetched at the same time
+    :param per_host:    The maximum number of images fetched at the same time from a single host
+    :return:            A list of (src, bytes, seconds) tuples with the timing of every image
+    """
+    url = host[4:]
+    path = os.path.join(os.getcwd(), url)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.mkdir(path)
+    limits = dict()
+    jobs = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        def submit(src):
+            future, name, saved_src = submit_image(executor, limits, src, pool, path, host, port, per_host)
+            jobs.append((future, name))
+            return saved_src
+
+        with open("./" + url + "/index.html", 'w') as html_file:
+            page = StreamingPage(html_file, submit)
+            pool.request(host, port, 'GET', '/', {'Accept-Encoding': ACCEPT_ENCODING}, sink=page.start, decode=True)
+            page.close()
+        return collect_images(jobs)
+
+
+def page_file(target: str) -> str:
+    """
+    Map the path of a page to the file the server serves for it, so /a/b and /a/b.html are the same page
+
+    :param target:      The path of the page, e.g. / or /a/b
+    :return:            The path of the file, e.g. /index.html or /a/b.html
+    """
+    target = target.split('?')[0].split('#')[0]
+    if target.endswith('/'):
+        return target + 'index.html'
+    if '.' not in target.rsplit('/', 1)[-1]:
+        return target + '.html'
+    return target
+
+
+def mirror_path(root: str, target: str) -> str:
+    """
+    Map the path of a page to the file it is saved to in the mirrored tree
+
+    :param root:        The directory the host is mirrored in
+    :param target:      The path of the page, e.g. / or /a/b
+    :return:            The file path, e.g. root/index.html or root/a/b.html
+    """
+    rel_path = [part.replace('%20', ' ') for part in page_file(target).lstrip('/').split('/')]
+    return create_dirs(rel_path[:-1], root) + rel_path[-1]
+
+
+def parse_url(url: str, port: int) -> (str, int, str):
+    """
+    Split a URL given as host/path, host:port/path or http://host/path
+
+    :param url:         The URL
+    :param port:        The port to use if the URL does not name one
+    :return:            A tuple of the host, port and path of the URL
+    """
+    parts = urlsplit(url if '://' in url else 'http://' + url)
+    target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    return parts.hostname, parts.port or port, target
+
+
+class Crawl(object):
+    """
+    A crawl over pages and their images, sharing one frontier of URLs so every page and image is fetched once
+    """
+
+    def __init__(self, pool: ConnectionPool, workers: int = 1, per_host: int = 4):
+        """
+        :param pool:        The connection pool to fetch pages and images over
+        :param workers:     The number of pages, and separately images, fetched at the same time
+        :param per_host:    The maximum number of images fetched at the same time from a single host
+        """
+        self.pool = pool
+        self.workers = max(workers, 1)
+        self.per_host = per_host
+        self.seen = set()  # (host, port, page file) of every page that was queued
+        self.images = dict()  # Image URL, or host and path for local images and other files -> (future, name)
+        self.limits = dict()
+        self.roots = dict()  # Host -> directory it is mirrored in
+        self.pages = 0
+        self.page_bytes = 0
+        self._lock = threading.Lock()
+        self._image_executor = None
+
+    def root(self, host: str) -> str:
+        """
+        Create the directory a host is mirrored in, removing what a previous run left there
+
+        :param host:        The host
+        :return:            The directory
+        """
+        with self._lock:
+            if host not in self.roots:
+                path = os.path.join(os.getcwd(), host[4:] if host.startswith('www.') else host)
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                os.mkdir(path)
+                self.roots[host] = path
+            return self.roots[host]
+
+    def run(self, urls: list, depth: int) -> list:
+        """
+        Fetch the pages breadth first, following links on the same host up to depth links away from the start
+
+        :param urls:        The (host, port, target) tuples to start from
+        :param depth:       The maximum number of links followed from a start URL
+        :return:            A list of (name, bytes, seconds) tuples with the timing of every image
+        """
+        frontier = []
+        for host, port, target in urls:
+            if (host, port, page_file(target)) not in self.seen:
+                self.seen.add((host, port, page_file(target)))
+                frontier.append((host, port, target))
+        with ThreadPoolExecutor(max_workers=self.workers) as page_executor, \
+                ThreadPoolExecutor(max_workers=self.workers) as self._image_executor:
+            for level in range(depth + 1):
+                futures = [page_executor.submit(self.crawl_page, *url) for url in frontier]
+                frontier = []
+                for future in futures:
+                    for host, port, target in future.result():
+                        if level < depth and (host, port, page_file(target)) not in self.seen:
+                            self.seen.add((host, port, page_file(target)))
+                            frontier.append((host, port, target))
+                if not frontier:
+                    break
+            return collect_images(list(self.images.values()))
+
+    def fetch_file(self, host: str, port: int, src: str, root: str, url: str = None):
+        """
+        Start fetching an image or other file that is not a page, unless it was already queued
+
+        :param host:        The host of the page referring to it
+        :param port:        The port to connect on
+        :param src:         The path of the file on the host, or the src of an external image
+        :param root:        The directory the host is mirrored in
+        :param url:         The absolute URL of an external image, None for files on the host of the page
+        """
+        key = url or (host, src)  # Local files are the same whichever port or spelling of the host the page used
+        with self._lock:
+            if key not in self.images:
+                future, name, _ = submit_image(self._image_executor, self.limits, src, self.pool, root, host, port,
+                                               self.per_host)
+                self.images[key] = (future, name)
+
+    def crawl_page(self, host: str, port: int, target: str) -> list:
+        """
+        Fetch a page, save it in the mirrored tree, start fetching its images and collect its links
+
+        :param host:        The host of the page
+        :param port:        The port to connect on
+        :param target:      The path of the page
+        :return:            The (host, port, target) tuples of the links to pages on the same host
+        """
+        status, headers, body = get(self.pool, host, port, target)
+        page_url = 'http://{h}:{p}{t}'.format(h=host, p=port, t=target)
+        if status != 200:
+            print('Skipping {url}: {status}'.format(url=page_url, status=status))
+            return []
+        root = self.root(host)
+        if not is_html(headers.get('Content-Type', '')):  # Saved like an image instead of being parsed
+            self.fetch_file(host, port, urlsplit(target).path, root)
+            return []
+        file_path = mirror_path(root, target)
+        with TRACER.span('parse_html'):
+            soup = BeautifulSoup(body, 'html.parser')
+        for image in soup.find_all('img'):
+            src = image.get('src')
+            if not src:
+                continue
+            image_url = urljoin(page_url, src)
+            if is_image_local(image_url, host):
+                src = urlsplit(image_url).path  # Relative to the page, resolve it against the page's path
+                self.fetch_file(host, port, src, root)
+                # Point to the saved copy, relative to the saved page
+                saved = os.path.join(root, src.lstrip('/').replace('%20', ' '))
+                image['src'] = os.path.relpath(saved, os.path.dirname(file_path)).replace(os.sep, '/')
             else:
-                new_path = create_dirs(rel_path, path)
-            data = fetch_local_image(src, host, port)
-            save_local_image(new_path, file_name, data, image, src)
+                self.fetch_file(host, port, src, root, image_url)
+        links = []
+        for anchor in soup.find_all('a'):
+            href = anchor.get('href')
+            if not href:
+                continue
+            parts = urlsplit(urljoin(page_url, href))
+            if parts.scheme == 'http' and parts.hostname == host and (parts.port or 80) in (port, 80):
+                content_type = mimetypes.guess_type(page_file(parts.path or '/'))[0]
+                if content_type is not None and not is_html(content_type):
+                    self.fetch_file(host, port, parts.path, root)  # Not a page, e.g. a linked image or PDF
+                    continue
+                links.append((host, port, (parts.path or '/') + ('?' + parts.query if parts.query else '')))
+        with open(file_path, 'w') as html_file:
+            html_file.write(soup.prettify())
+        with self._lock:
+            self.pages += 1
+            self.page_bytes += len(body.encode())
+        return links
+
+
+def is_html(content_type: str) -> bool:
+    """
+    :param content_type:    The value of a Content-Type header
+    :return:                Whether it is a page the crawler parses for links and images
+    """
+    return content_type.split(';', 1)[0].strip().lower() in ('text/html', 'application/xhtml+xml')
+
+
+def crawl(pool: ConnectionPool, urls: list, depth: int, workers: int = 1, per_host: int = 4) -> Crawl:
+    """
+    Crawl pages and their images into a mirrored directory tree per host and report the throughput
+
+    :param pool:        The connection pool to fetch pages and images over
+    :param urls:        The (host, port, target) tuples to start from
+    :param depth:       The maximum number of links followed from a start URL, 0 only fetches the given URLs
+    :param workers:     The number of pages, and separately images, fetched at the same time
+    :param per_host:    The maximum number of images fetched at the same time from a single host
+    :return:            The finished crawl
+    """
+    start = time.perf_counter()
+    crawler = Crawl(pool, workers, per_host)
+    timings = crawler.run(urls, depth)
+    elapsed = time.perf_counter() - start
+    total = crawler.page_bytes + sum(size for _, size, _ in timings)
+    print('Crawled {pages} pages and {images} images, {mb:.2f} MB in {s:.2f} s: {pps:.1f} pages/s, {bps:.0f} bytes/s'
+          .format(pages=crawler.pages, images=len(timings), mb=total / 1e6, s=elapsed, pps=crawler.pages / elapsed,
+                  bps=total / elapsed))
+    return crawler
+
+
+def parse_options(args: list) -> (dict, list):
+    """
+    Split the optional command line arguments into --name=value options and unknown arguments
+
+    :param args:        The optional arguments
+    :return:            A tuple of a dictionary of the options and a list of the other arguments
+    """
+    options = dict()
+    ignored = []
+    for arg in args:
+        if arg.startswith('--') and '=' in arg:
+            name, value = arg[2:].split('=', 1)
+            options[name] = value
         else:
-            full_url = src
-            if 'https://' in full_url:
-                full_url = full_url[8:]
-            else:
-                full_url = full_url[7:]
-            if full_url[0:4] != 'www.':
-                full_url = 'www.' + full_url
-            host, src = full_url.split('/')[0], full_url.split('/')[1:]
-            filter(None, src)
-            data = fetch_external_image(''.join(src), host, port)
+            ignored.append(arg)
+    return options, ignored
 
 
 # HEAD Request
@@ -226,34 +669,18 @@ def head(s, host):
     print(is_chunk_based(headers))
 
 
-# GET Request
-def get(s, host):
-    request = 'GET / HTTP/1.1\r\nHost: ' + host + '\r\n\r\n'
-    s.send(request.encode())
-    response = s.recv(1024).decode().split('\r\n\r\n')
-    headers = parse_headers(response[0])
-    if is_chunk_based(headers):
-        body = response[1].splitlines()[1]
-        encoding = get_encoding(headers, body)
-        chunk_length = int(response[1].splitlines()[0], 16)
-        remaining_bytes = chunk_length - len(body)
-        # remaining_bytes + 2 for the \r\n at the end of a chunk
-        body += read_and_decode(s, remaining_bytes + 2, encoding)
-        next_length, extra_body = get_new_chunk_length(s, encoding)
-        body += extra_body
-        while next_length != 0:
-            body += read_and_decode(s, next_length + 2, encoding)
-            next_length, extra_body = get_new_chunk_length(s, encoding)
-            body += extra_body
-        s.close()
-    else:
-        body = response[1]
-        encoding = get_encoding(headers, body)
-        total_length = headers['Content-Length']
-        remaining_bytes = int(total_length) - len(body)
-        body += read_and_decode(s, remaining_bytes, encoding)
-        s.close()
-    return body
+# GET Request, returns the status, headers and decoded body
+def get(pool: ConnectionPool, host: str, port: int, target: str = '/') -> (int, dict, str):
+    # A compressed page is decoded while it arrives, before the charset is looked up
+    with TRACER.span('get', target):
+        response = pool.request(host, port, 'GET', target, {'Accept-Encoding': ACCEPT_ENCODING}, decode=True)
+    # A page has to declare its charset within its first 1024 bytes, so only those are searched
+    encoding = get_encoding(response.headers, response.body[:1024].decode('latin-1'))
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        encoding = 'utf-8'
+    return response.status, response.headers, response.body.decode(encoding, errors='replace')  # Decoded once
 
 
 def post(s: socket.socket, host: str, url: str = '/'):
@@ -290,15 +717,49 @@ def run(arg: list):
         (host, url) = full_url.split('/', 1)
     else:
         (host, url) = (full_url, '')
-    if len(arg) > 3:
-        print('Ignoring optional arguments: ' + str(arg[3:]))
+    options, ignored = parse_options(arg[3:])
+    if ignored:
+        print('Ignoring optional arguments: ' + str(ignored))
+    if arguments[0] == 'GET':
+        # --workers=N fetches N images at once, --per-host=N bounds the concurrent fetches from one host
+        workers, per_host = int(options.get('workers', 1)), int(options.get('per-host', 4))
+        # Responses are kept in --cache-dir (default .http_cache, at most --cache-size bytes), --cache=0 disables it
+        cache = None
+        if options.get('cache') != '0':
+            cache = HttpCache(options.get('cache-dir', os.path.join(os.getcwd(), '.http_cache')),
+                              int(options.get('cache-size', 256 * 1024 * 1024)))
+        pool = ConnectionPool(max_idle_per_host=per_host, cache=cache)  # The page and its images share connections
+        # --trace=FILE records how long every phase takes, written as a Chrome trace if FILE ends with .json and
+        # as folded flame graph stacks otherwise
+        if 'trace' in options:
+            TRACER.enable()
+        if 'crawl' in options or 'urls' in options:
+            # --crawl=N follows links on the same host N levels deep, --urls=FILE crawls the URLs listed in FILE
+            urls = [parse_url(full_url, port)]
+            if 'urls' in options:
+                with open(options['urls']) as url_file:
+                    urls = [parse_url(line.strip(), port) for line in url_file if line.strip()]
+            crawl(pool, urls, int(options.get('crawl', 0)), workers, per_host)
+        elif options.get('stream') == '1':  # --stream=1 writes the page while it arrives instead of prettifying it
+            stream_body(host, pool, port, workers, per_host)
+        else:
+            _, _, body = get(pool, host, port)
+            # --pipeline=N fetches the local images over one connection with up to N requests in flight
+            with TRACER.span('save_body'):
+                save_body(body, host, pool, port, workers, per_host, int(options.get('pipeline', 0)))
+        pool.close()
+        print('Connections opened: {n}'.format(n=pool.connects))
+        if 'trace' in options:
+            TRACER.write(options['trace'])
+            print('Trace written to ' + options['trace'])
+        if cache is not None:
+            print('Cache: {hits} fresh hits, {revalidations} revalidated with 304'.format(
+                hits=cache.hits, revalidations=cache.revalidations))
+        return
     s = create_new_socket()
     s.connect((host, port))
     if arguments[0] == 'HEAD':
         head(s, host)
-    elif arguments[0] == 'GET':
-        body = get(s, host)
-        save_body(body, host, s, port)
     elif arguments[0] == 'POST':
         post(s, host, '/' + url)
     elif arguments[0] == 'PUT':
@@ -0,0 +1,434 @@
+import socket
+import threading
+import time
+import zlib
+from func import ChunkedDecoder, ParseError, parse_header_lines
+from tracing import TRACER
+
+try:
+    import brotli  # Optional, without it brotli is not offered to servers
+except ImportError:
+    brotli = None
+
+ACCEPT_ENCODING = 'br, gzip, deflate' if brotli is not None else 'gzip, deflate'
+
+
+def find_head_end(buffer: bytearray, start: int) -> (int, int):
+    """
+    Find the empty line ending the head of a response, accepting bare LF line endings as well as CRLF
+
+    :param buffer:      The received bytes
+    :param start:       Position to start searching from
+    :return:            A tuple of the position of the empty line and the length of the separator, (-1, 0) if absent
+    """
+    crlf = buffer.find(b'\r\n\r\n', start)
+    lf = buffer.find(b'\n\n', start)
+    if lf >= 0 and (crlf < 0 or lf < crlf):
+        return lf, 2
+    if crlf >= 0:
+        return crlf, 4
+    return -1, 0
+
+
+class ContentDecoder(object):
+    """
+    Streaming decoder of a gzip, deflate or brotli encoded body, passing the decoded bytes on as they arrive
+    """
+    ENCODINGS = ('gzip', 'x-gzip', 'deflate', 'br') if brotli is not None else ('gzip', 'x-gzip', 'deflate')
+
+    def __init__(self, encoding: str, write):
+        """
+        :param encoding:    The Content-Encoding of the body, one of ENCODINGS
+        :param write:       Function called with every piece of decoded bytes
+        """
+        self._write = write
+        if encoding == 'br':
+            self._decompressor = brotli.Decompressor()
+            self._decompress = self._decompressor.process
+        else:
+            # gzip has a header and trailer around the deflate stream, deflate means the zlib format
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16 if 'gzip' in encoding else zlib.MAX_WBITS)
+            self._decompress = self._decompressor.decompress
+
+    def write(self, data):
+        decoded = self._decompress(data)
+        if decoded:
+            self._write(decoded)
+
+    def close(self):
+        """
+        Pass on the bytes still buffered by the decompressor
+        """
+        if hasattr(self._decompressor, 'flush'):
+            decoded = self._decompressor.flush()
+            if decoded:
+                self._write(decoded)
+
+
+class Response(object):
+    """
+    A received HTTP response
+    """
+
+    def __init__(self, status: int, reason: str, headers: dict, body: bytearray, length: int):
+        self.status = status
+        self.reason = reason
+        self.headers = headers  # Header names are title-cased, values are stripped
+        self.body = body  # Empty if the body was written to a sink, decoded if a Content-Encoding was decoded
+        self.length = length  # Number of body bytes received before decoding, or read from the cache
+
+
+class Connection(object):
+    """
+    A keep-alive connection to a host, together with the bytes received after the last response
+    """
+    PACKET_SIZE = 64 * 1024
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.host = host
+        self.port = port
+        with TRACER.span('connect', host):
+            self.sock = socket.create_connection((host, port), timeout)
+        self.buffer = bytearray()  # Received bytes that belong to the next response
+        self.reusable = True  # False once the server closes or the framing of a response is unknown
+        self.last_used = time.monotonic()
+        self.requests = 0  # Number of requests sent on this connection
+        self.head_received = False  # Whether the head of the response to the last request arrived
+        self._scratch = memoryview(bytearray(self.PACKET_SIZE))  # recv_into target reused for every read
+
+    def format_request(self, method: str, target: str, headers: dict = None) -> bytes:
+        """
+        Encode a request without a body
+
+        :param method:      The request method
+        :param target:      The request target, e.g. /index.html
+        :param headers:     Extra request headers
+        :return:            The encoded request
+        """
+        request = method + ' ' + target + ' HTTP/1.1\r\nHost: ' + self.host + '\r\nConnection: keep-alive\r\n'
+        for key, value in (headers or {}).items():
+            request += key + ': ' + value + '\r\n'
+        return (request + '\r\n').encode()
+
+    def send_request(self, method: str, target: str, headers: dict = None):
+        """
+        Send a request without a body
+
+        :param method:      The request method
+        :param target:      The request target, e.g. /index.html
+        :param headers:     Extra request headers
+        """
+        with TRACER.span('send', target):
+            self.sock.sendall(self.format_request(method, target, headers))
+        self.requests += 1
+        self.head_received = False
+
+    def send_requests(self, method: str, targets: list, headers: dict = None):
+        """
+        Send several requests without a body in a single write, without waiting for their responses
+
+        :param method:      The request method, which has to be idempotent as unanswered requests may be resent
+        :param targets:     The request targets
+        :param headers:     Extra request headers, sent with every request
+        """
+        with TRACER.span('send'):
+            self.sock.sendall(b''.join(self.format_request(method, target, headers) for target in targets))
+        self.requests += len(targets)
+
+    def _recv(self, size: int = PACKET_SIZE) -> memoryview:
+        """
+        Receive at most size bytes into the scratch buffer
+
+        :param size:        The maximum number of bytes to receive
+        :return:            A view on the received bytes, only valid until the next receive
+        """
+        received = self.sock.recv_into(self._scratch, min(size, self.PACKET_SIZE))
+        if not received:
+            self.reusable = False
+        return self._scratch[:received]
+
+    def _fill(self) -> bool:
+        """
+        Receive more bytes into the buffer
+
+        :return:            False if the server closed the connection
+        """
+        data = self._recv()
+        self.buffer += data
+        return len(data) > 0
+
+    def _read_into(self, view: memoryview):
+        """
+        Fill a preallocated buffer with the next bytes of the connection
+
+        :param view:        The buffer to fill completely
+        """
+        pos = min(len(self.buffer), len(view))
+        view[:pos] = self.buffer[:pos]
+        del self.buffer[:pos]
+        while pos < len(view):
+            received = self.sock.recv_into(view[pos:])
+            if not received:
+                self.reusable = False
+                raise ConnectionError('Connection closed before the whole body was received')
+            pos += received
+
+    def _read_to(self, sink, count: int):
+        """
+        Write the next count bytes of the connection to a sink
+
+        :param sink:        File-like object to write the bytes to
+        :param count:       The number of bytes to move
+        """
+        pos = min(len(self.buffer), count)
+        sink.write(self.buffer[:pos])
+        del self.buffer[:pos]
+        while pos < count:
+            data = self._recv(count - pos)
+            if not data:
+                raise ConnectionError('Connection closed before the whole body was received')
+            sink.write(data)
+            pos += len(data)
+
+    def read_response(self, method: str = 'GET', sink=None, decode: bool = False) -> Response:
+        """
+        Read one response, framing its body by Content-Length, chunked encoding or connection close
+
+        :param method:      The method of the request the response answers
+        :param sink:        File-like object to stream the body to instead of keeping it in memory, or a function
+                            of the response headers returning one
+        :param decode:      Whether to decode a gzip, deflate or brotli Content-Encoding while receiving the body
+        :return:            The response
+        """
+        self.head_received = False
+        with TRACER.span('wait_head'):  # Until the response starts arriving, the server's time
+            end, separator = find_head_end(self.buffer, 0)
+            while end < 0:
+                scanned = max(len(self.buffer) - 3, 0)
+                if not self._fill():
+                    raise ConnectionError('Connection closed before the response headers were received')
+                end, separator = find_head_end(self.buffer, scanned)
+        self.head_received = True
+        lines = [line.rstrip('\r') for line in self.buffer[:end].decode('latin-1').split('\n')]
+        del self.buffer[:end + separator]
+        version, _, status_reason = lines[0].partition(' ')
+        status, _, reason = status_reason.partition(' ')
+        headers = parse_header_lines(lines[1:])
+        if headers.get('Connection', '').lower() == 'close' or version == 'HTTP/1.0':
+            self.reusable = False
+        if callable(sink):
+            sink = sink(headers)
+
+        body = bytearray()
+        encoding = headers.get('Content-Encoding', '').strip().lower()
+        content_decoder = None
+        if decode and encoding in ContentDecoder.ENCODINGS:
+            content_decoder = ContentDecoder(encoding, body.extend if sink is None else sink.write)
+            sink = content_decoder
+        write = body.extend if sink is None else sink.write
+        length = 0
+        if method == 'HEAD' or status.startswith('1') or status in ('204', '304'):
+            pass  # These responses never have a body
+        elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            decoder = ChunkedDecoder()
+            pos = 0
+            while True:
+                pieces, pos = decoder.decode(self.buffer, pos)
+                for piece in pieces:
+                    write(piece)
+                    length += len(piece)
+                if decoder.done:
+                    break
+                del self.buffer[:pos]
+                pos = 0
+                if not self._fill():
+                    raise ConnectionError('Connection closed in the middle of a chunked body')
+            del self.buffer[:pos]
+            headers.update(decoder.trailers)
+        elif 'Content-Length' in headers:
+            if not headers['Content-Length'].isdigit() or not headers['Content-Length'].isascii():
+                raise ParseError('Invalid Content-Length: ' + headers['Content-Length'])
+            length = int(headers['Content-Length'])
+            if sink is None:
+                body = bytearray(length)  # Received in place, without intermediate copies
+                self._read_into(memoryview(body))
+            else:
+                self._read_to(sink, length)
+        else:  # The body ends when the server closes the connection
+            write(self.buffer)
+            length = len(self.buffer)
+            self.buffer.clear()
+            data = self._recv()
+            while data:
+                write(data)
+                length += len(data)
+                data = self._recv()
+        if content_decoder is not None:
+            content_decoder.close()
+        self.last_used = time.monotonic()
+        return Response(int(status), reason, headers, body, length)
+
+    def close(self):
+        self.reusable = False
+        self.sock.close()
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive connections per (host, port) so later requests skip the TCP handshake
+    """
+
+    def __init__(self, max_idle_per_host: int = 4, idle_timeout: float = 5.0, timeout: float = 10.0, cache=None):
+        """
+        :param max_idle_per_host:   Maximum number of idle connections kept per (host, port)
+        :param idle_timeout:        Seconds after which an idle connection is closed instead of reused
+        :param timeout:             Socket timeout of the connections
+        :param cache:               http_cache.HttpCache serving and revalidating GET requests, None to disable
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.cache = cache
+        self._idle = dict()  # (host, port) -> list of idle connections, most recently used last
+        self._lock = threading.Lock()
+        self.connects = 0  # Number of connections opened, for statistics
+
+    def acquire(self, host: str, port: int) -> Connection:
+        """
+        Take an idle connection to the host or open a new one
+
+        :param host:        The host to connect to
+        :param port:        The port to connect on
+        :return:            A connection that is not used by anybody else
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get((host, port), [])
+            while idle:
+                conn = idle.pop()
+                if now - conn.last_used < self.idle_timeout:
+                    return conn
+                conn.close()  # Servers drop idle connections, do not risk reusing it
+            self.connects += 1
+        return Connection(host, port, self.timeout)
+
+    def release(self, conn: Connection):
+        """
+        Return a connection to the pool, or close it if it can not be reused
+
+        :param conn:        The connection to return
+        """
+        if conn.reusable and not conn.buffer:
+            with self._lock:
+                idle = self._idle.setdefault((conn.host, conn.port), [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def request(self, host: str, port: int, method: str, target: str, headers: dict = None, sink=None,
+                decode: bool = False) -> Response:
+        """
+        Send a request over a pooled connection and read its response
+
+        :param host:        The host to send the request to
+        :param port:        The port of the host
+        :param method:      The request method
+        :param target:      The request target, e.g. /index.html
+        :param headers:     Extra request headers
+        :param sink:        File-like object to stream the body to instead of keeping it in memory, or a function
+                            of the response headers returning one
+        :param decode:      Whether to decode a gzip, deflate or brotli Content-Encoding while receiving the body
+        :return:            The response
+        """
+        if self.cache is not None and method == 'GET':
+            return self.cache.request(lambda extra_headers, cache_sink: self._request(
+                host, port, method, target, extra_headers, cache_sink, decode), host, port, target, headers, sink)
+        return self._request(host, port, method, target, headers, sink, decode)
+
+    def _request(self, host: str, port: int, method: str, target: str, headers: dict, sink, decode: bool) -> Response:
+        """
+        Send a request over a pooled connection and read its response, bypassing the cache
+        """
+        conn = self.acquire(host, port)
+        try:
+            try:
+                conn.send_request(method, target, headers)
+                with TRACER.span('response', target):
+                    response = conn.read_response(method, sink, decode)
+            except ConnectionError:
+                if conn.requests == 1 or conn.head_received:
+                    raise
+                # The server closed the idle connection before it received the request, retry on a new one
+                conn.close()
+                conn = Connection(host, port, self.timeout)
+                with self._lock:
+                    self.connects += 1
+                conn.send_request(method, target, headers)
+                response = conn.read_response(method, sink, decode)
+        except Exception:
+            conn.close()
+            raise
+        self.release(conn)
+        return response
+
+    def pipeline(self, host: str, port: int, targets: list, sinks: list = None, headers: dict = None,
+                 depth: int = 16) -> list:
+        """
+        Send GET requests for several targets over one connection, keeping up to depth requests in flight instead
+        of waiting for every response before sending the next request. Responses are read in request order, and
+        requests the server did not answer before closing the connection are resent on a new one. The cache is
+        bypassed.
+
+        :param host:        The host to send the requests to
+        :param port:        The port of the host
+        :param targets:     The request targets
+        :param sinks:       A sink per target, see request, or None to keep the bodies in memory
+        :param headers:     Extra request headers, sent with every request
+        :param depth:       The maximum number of requests sent before their responses are read
+        :return:            The responses, in the order of targets
+        """
+        responses = []
+        conn = self.acquire(host, port)
+        sent = 0  # Number of targets sent on this connection
+        answered = 0  # Number of responses read from this connection
+        try:
+            while len(responses) < len(targets):
+                if sent - len(responses) < depth // 2 + 1:  # Top up the requests in flight in batches
+                    batch = targets[sent:len(responses) + depth]
+                    if batch:
+                        conn.send_requests('GET', batch, headers)
+                        sent += len(batch)
+                try:
+                    with TRACER.span('response', targets[len(responses)]):
+                        response = conn.read_response('GET', sinks[len(responses)] if sinks else None)
+                except ConnectionError:
+                    if conn.head_received or (answered == 0 and conn.requests == sent - len(responses)):
+                        raise  # Part of the response was received, or a fresh connection failed
+                    conn.reusable = False  # Closed before answering, resend the unanswered requests below
+                else:
+                    responses.append(response)
+                    answered += 1
+                if not conn.reusable and len(responses) < len(targets):
+                    conn.close()
+                    conn = Connection(host, port, self.timeout)
+                    with self._lock:
+                        self.connects += 1
+                    sent, answered = len(responses), 0
+        except Exception:
+            conn.close()
+            raise
+        self.release(conn)
+        return responses
+
+    def close(self):
+        """
+        Close every idle connection and write the index of the cache
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,131 @@
+import os
+import queue
+import threading
+import time
+
+
+class AccessLog(object):
+    """
+    Access log written by a background thread, so request handlers only queue a tuple per request
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5, flush_interval=1.0):
+        """
+        Parameters:
+            - path: file to append the log lines to, None disables logging
+            - max_bytes: size after which the file is rotated to path.1, path.2, ...
+            - backups: number of rotated files to keep
+            - flush_interval: maximum number of seconds a line waits before it is written
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.enabled = path is not None
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._file = None
+
+    def log(self, address, method, target, version, status, length, duration):
+        """
+        Queues a line for a handled request, formatting and writing happen on the logging thread
+        Parameters:
+            - address: (host, port) of the client
+            - method, target, version: request line of the request
+            - status: status code of the response
+            - length: number of bytes of the response
+            - duration: seconds it took to build the response
+        """
+        if not self.enabled:
+            return
+        if self._thread is None:
+            self._start()  # Started lazily so a pre-forking master never forks with a running thread
+        self._queue.put((time.time(), address, method, target, version, status, length, duration))
+
+    def close(self):
+        """
+        Writes the queued lines and stops the logging thread
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """
+        Main loop of the logging thread: waits for lines and writes everything queued in one batch
+        """
+        running = True
+        while running:
+            try:
+                entries = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            try:
+                while True:
+                    entries.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in entries:
+                running = False
+                entries = [entry for entry in entries if entry is not None]
+            if entries:
+                self._write(''.join(self._format(entry) for entry in entries))
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _format(entry):
+        """
+        Formats a queued entry in the Common Log Format, followed by the handling time in milliseconds
+        """
+        timestamp, address, method, target, version, status, length, duration = entry
+        return '{host} - - [{date}] "{method} {target} {version}" {status} {length} {ms:.3f}\n'.format(
+            host=address[0] if address else '-', date=time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(timestamp)),
+            method=method, target=target, version=version, status=status, length=length, ms=duration * 1000)
+
+    def _write(self, text):
+        """
+        Appends a batch of lines to the log, rotating it first if it grew past max_bytes
+        Parameters:
+            - text: the formatted lines
+        """
+        try:
+            if self._file is not None:
+                try:
+                    if os.fstat(self._file.fileno()).st_ino != os.stat(self.path).st_ino:
+                        raise FileNotFoundError(self.path)
+                except OSError:
+                    self._file.close()  # Another worker process rotated the file, write to the new one
+                    self._file = None
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            if os.fstat(self._file.fileno()).st_size >= self.max_bytes:  # Including what other workers appended
+                self._rotate()
+            self._file.write(text)
+            self._file.flush()  # One write per batch, worker processes appending to the same file do not interleave
+        except OSError as error:
+            print("Error: Could not write access log: {e}".format(e=error))
+
+    def _rotate(self):
+        """
+        Shifts path.1 ... path.(backups - 1) up by one, moves the current file to path.1 and reopens it
+        """
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('{p}.{i}'.format(p=self.path, i=i)):
+                os.replace('{p}.{i}'.format(p=self.path, i=i), '{p}.{i}'.format(p=self.path, i=i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a')
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry(object):
+    """
+    A cached file: its content, size, modification time and precomputed response headers
+    """
+    __slots__ = ('data', 'size', 'mtime', 'headers', 'checked_at')
+
+    def __init__(self, data, size, mtime, headers):
+        self.data = data
+        self.size = size
+        self.mtime = mtime
+        self.headers = headers  # Encoded headers following the status and Date lines
+        self.checked_at = time.monotonic()  # Last time the entry was validated against the file
+
+
+class FileCache(object):
+    """
+    Bounded in-memory cache of static files with LRU eviction and mtime revalidation
+    """
+
+    def __init__(self, header_builder, max_bytes=64 * 1024 * 1024, max_file_size=1024 * 1024,
+                 revalidate_interval=1.0):
+        """
+        Parameters:
+            - header_builder: function of a file's path, length and mtime returning its encoded headers
+            - max_bytes: total number of content bytes the cache may hold
+            - max_file_size: files larger than this are never cached
+            - revalidate_interval: seconds an entry is trusted before its file is stat'ed again
+        """
+        self.header_builder = header_builder
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_interval = revalidate_interval
+        self.size = 0  # Number of content bytes currently cached
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filepath):
+        """
+        Returns the entry for a file, reading it from disk only if it is not cached or changed
+        Parameters:
+            - filepath: path of the file to look up
+        Returns:
+            The CacheEntry of the file, whose data is None if the file is larger than max_file_size
+        Raises:
+            FileNotFoundError if the file does not exist
+        """
+        key = os.path.normpath(filepath)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if time.monotonic() - entry.checked_at < self.revalidate_interval:
+                    return entry
+
+        stat = os.stat(key)
+        if entry is not None and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+            entry.checked_at = time.monotonic()
+            return entry
+        if stat.st_size > self.max_file_size:
+            self.invalidate(key)
+            return CacheEntry(None, stat.st_size, stat.st_mtime, self.header_builder(key, stat.st_size, stat.st_mtime))
+
+        with open(key, 'rb') as f:
+            data = f.read()
+        entry = CacheEntry(data, len(data), stat.st_mtime, self.header_builder(key, len(data), stat.st_mtime))
+        self._store(key, entry)
+        return entry
+
+    def invalidate(self, filepath):
+        """
+        Drops a file from the cache, for example after it was written to
+        Parameters:
+            - filepath: path of the file to drop
+        """
+        key = os.path.normpath(filepath)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def _store(self, key, entry):
+        """
+        Stores an entry and evicts the least recently used entries until the cache fits in max_bytes
+        Parameters:
+            - key: normalized path of the file
+            - entry: CacheEntry to store
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            if entry.size > self.max_file_size or entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
@@ -0,0 +1,143 @@
+import gzip
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli  # Optional, without it only gzip is offered
+except ImportError:
+    brotli = None
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)  # In order of preference
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}  # Extensions of precompressed siblings
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+
+def is_compressible(content_type):
+    """
+    Whether a content type benefits from compression, images other than SVG are already compressed
+    Parameters:
+        - content_type: MIME type of the file
+    """
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate(accept_encoding):
+    """
+    Picks the preferred encoding the client accepts
+    Parameters:
+        - accept_encoding: value of the Accept-Encoding header
+    Returns:
+        One of ENCODINGS, or None to send the content as is
+    """
+    accepted = dict()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    """
+    Compresses data with the given encoding
+    Parameters:
+        - data: bytes to compress
+        - encoding: one of ENCODINGS
+    Returns:
+        The compressed bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)  # A fixed mtime keeps the output, and ETag, stable
+
+
+class CompressedEntry(object):
+    """
+    A compressed representation of a file together with its precomputed response headers
+    """
+    __slots__ = ('data', 'headers')
+
+    def __init__(self, data, headers):
+        self.data = data
+        self.headers = headers  # Encoded headers following the status and Date lines
+
+
+class CompressedCache(object):
+    """
+    Bounded LRU cache of compressed files keyed by path, mtime and encoding
+    """
+
+    def __init__(self, header_builder, max_bytes=16 * 1024 * 1024):
+        """
+        Parameters:
+            - header_builder: function of a file's path, compressed length, CacheEntry and encoding returning
+              its encoded headers
+            - max_bytes: total number of compressed bytes the cache may hold
+        """
+        self.header_builder = header_builder
+        self.max_bytes = max_bytes
+        self.size = 0  # Number of compressed bytes currently cached
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filepath, entry, encoding):
+        """
+        Returns a compressed representation of a file, preferring a precompressed sibling such as index.html.gz
+        over compressing the content once
+        Parameters:
+            - filepath: path of the file
+            - entry: CacheEntry holding the content of the file
+            - encoding: one of ENCODINGS
+        Returns:
+            The CompressedEntry of the file
+        """
+        key = (os.path.normpath(filepath), entry.mtime, encoding)
+        with self._lock:
+            compressed = self._entries.get(key)
+            if compressed is not None:
+                self._entries.move_to_end(key)
+                return compressed
+
+        sibling = key[0] + SUFFIXES[encoding]
+        try:
+            if os.stat(sibling).st_mtime < entry.mtime:
+                raise FileNotFoundError(sibling)  # Outdated, compress the current content instead
+            with open(sibling, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = compress(entry.data, encoding)
+        compressed = CompressedEntry(data, self.header_builder(key[0], len(data), entry, encoding))
+        self._store(key, compressed)
+        return compressed
+
+    def _store(self, key, entry):
+        """
+        Stores an entry and evicts the least recently used entries until the cache fits in max_bytes
+        Parameters:
+            - key: (path, mtime, encoding) of the entry
+            - entry: CompressedEntry to store
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.data)
+            if len(entry.data) > self.max_bytes:
+                return
+            # Older versions of the file can never be requested again
+            for stale in [k for k in self._entries if k[0] == key[0] and k[1] != key[1]]:
+                self.size -= len(self._entries.pop(stale).data)
+            self._entries[key] = entry
+            self.size += len(entry.data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.data)
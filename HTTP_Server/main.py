@@ -1,38 +1,367 @@
+import argparse
+import calendar
+import errno
+import itertools
+import mimetypes
+import os
+import multiprocessing
+import multiprocessing.connection
+import selectors
+import signal
 import socket
 import sys
 import time
-from datetime import datetime
+from collections import deque
+from urllib.parse import quote
 import threading
-from os import path
-from func import parse_headers
+from func import ParseError, RequestParser
+from tracing import TRACER
+from access_log import AccessLog
+from uploads import Discard, Upload, UploadStore
+from cache import FileCache
+from compression import ENCODINGS, CompressedCache, is_compressible, negotiate
+from metrics import Metrics
+from routing import Router, normalize
+from validators import ValidatorIndex, make_etag
 
+try:
+    import resource  # Not available on Windows, connections are then not capped by the descriptor limit
+except ImportError:
+    resource = None
 
-def generate_headers(response_code, length=0):
+
+STATUS_LINES = {
+    200: b'HTTP/1.1 200 OK\r\n',
+    206: b'HTTP/1.1 206 Partial Content\r\n',
+    304: b'HTTP/1.1 304 Not Modified\r\n',
+    400: b'HTTP/1.1 400 Bad Request\r\n',
+    404: b'HTTP/1.1 404 Not Found\r\n',
+    408: b'HTTP/1.1 408 Request Timeout\r\n',
+    416: b'HTTP/1.1 416 Range Not Satisfiable\r\n',
+    500: b'HTTP/1.1 500 Server Error\r\n',
+    503: b'HTTP/1.1 503 Service Unavailable\r\n',
+}
+SERVER_HEADER = b'Server: CN Assignment 1 O. Vandenryt\r\n'
+KEEP_ALIVE_END = b'Connection: keep-alive\r\n\r\n'  # Signal that connection will be kept alive
+CLOSE_END = b'Connection: close\r\n\r\n'
+CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'  # Interim response telling a client to send the body it holds back
+IOV_MAX = 1024  # Maximum number of buffers passed to one sendmsg call on Linux and macOS
+FDS_PER_CONNECTION = 2  # A client socket, plus a streamed file or an upload
+RESERVED_FDS = 64  # Descriptors kept free for the listening socket, logs, cached handles and imports
+ACCEPT_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)  # accept() backs off on these
+
+
+class DateClock(object):
+    """
+    Date header shared by every response, formatted at most once per second
+    """
+
+    def __init__(self):
+        self._second = None
+        self._header = b''
+
+    def header(self):
+        """
+        Returns:
+            The encoded Date header line for the current second
+        """
+        now = int(time.time())
+        if now != self._second:
+            self._header = 'Date: {now}\r\n'.format(now=http_date(now)).encode()
+            self._second = now  # Set last, a racing thread at worst formats the same second twice
+        return self._header
+
+
+DATE_CLOCK = DateClock()
+
+
+def http_date(timestamp):
+    """
+    Formats a timestamp as an HTTP date, e.g. Sun, 06 Nov 1994 08:49:37 GMT
+    Parameters:
+        - timestamp: seconds since the epoch
+    Returns:
+        The formatted date
+    """
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(timestamp))
+
+
+def generate_headers(response_code, length=0, extra_headers=None, keep_alive=True):
     """
     Generate HTTP response headers.
     Parameters:
-        - response_code: HTTP response code to add to the header. 200 and 404 supported
+        - response_code: HTTP response code to add to the header, one of STATUS_LINES
+        - length: value of the Content-Length header
+        - extra_headers: optional dictionary of additional headers
+        - keep_alive: False to announce that the connection is closed after the response
+    Returns:
+        The encoded HTTP header for the given response_code
+    """
+    return generate_status(response_code) + generate_entity_headers(length, extra_headers, keep_alive)
+
+
+def generate_status(response_code):
+    """
+    Generate the status line and Date header of an HTTP response.
+    Parameters:
+        - response_code: HTTP response code to add to the header
+    Returns:
+        The encoded status line followed by the Date header
+    """
+    return STATUS_LINES[response_code] + DATE_CLOCK.header()
+
+
+def generate_entity_headers(length=0, extra_headers=None, keep_alive=True):
+    """
+    Generate the headers following the Date header, which only depend on the content.
+    Parameters:
+        - length: value of the Content-Length header
+        - extra_headers: optional dictionary of additional headers, e.g. Content-Type, ETag or Last-Modified
+        - keep_alive: False to announce that the connection is closed after the response
     Returns:
-        A formatted HTTP header for the given response_code
-    """
-    header = ''
-    if response_code == 200:
-        header += 'HTTP/1.1 200 OK\n'
-    elif response_code == 304:
-        header += 'HTTP/1.1 304 Not Modified\n'
-    elif response_code == 400:
-        header += 'HTTP/1.1 400 Bad Request\n'
-    elif response_code == 404:
-        header += 'HTTP/1.1 404 Not Found\n'
-    elif response_code == 500:
-        header += 'HTTP/1.1 500 Server Error\n'
-
-    time_now = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime())
-    header += 'Date: {now}\n'.format(now=time_now)
-    header += 'Server: CN Assignment 1 O. Vandenryt\n'
-    header += 'Content-Length: {length}\n'.format(length=str(length))
-    header += 'Connection: keep-alive\n\n'  # Signal that connection will be kept alive
-    return header
+        The remaining encoded headers, terminated by an empty line
+    """
+    header = SERVER_HEADER + b'Content-Length: %d\r\n' % length
+    if extra_headers:
+        header += ''.join('{key}: {value}\r\n'.format(key=key, value=value)
+                          for key, value in extra_headers.items()).encode('latin-1')
+    return header + (KEEP_ALIVE_END if keep_alive else CLOSE_END)
+
+
+def file_headers(filepath, length, mtime, etag=None, encoding=None):
+    """
+    Generate the entity headers of a static file, cached together with the file.
+    Parameters:
+        - filepath: path of the file
+        - length: size of the file, or of its compressed representation
+        - mtime: modification time of the file
+        - etag: entity tag of the file, derived from length and mtime if omitted
+        - encoding: Content-Encoding of a compressed representation, None for the file itself
+    Returns:
+        The encoded headers following the Date header
+    """
+    mime_type = mimetypes.guess_type(filepath)[0]
+    content_type = mime_type or 'application/octet-stream'
+    if content_type.startswith('text/'):
+        content_type += '; charset=utf-8'
+    etag = etag or make_etag(length, mtime)
+    extra_headers = {'Content-Type': content_type, 'Last-Modified': http_date(mtime)}
+    if encoding is not None:
+        extra_headers['Content-Encoding'] = encoding
+        extra_headers['ETag'] = etag[:-1] + '-' + encoding + '"'  # Every representation needs its own tag
+    else:
+        extra_headers['ETag'] = etag
+        extra_headers['Accept-Ranges'] = 'bytes'  # Ranges are only served on the uncompressed file
+    if is_compressible(mime_type):
+        extra_headers['Vary'] = 'Accept-Encoding'
+    return generate_entity_headers(length, extra_headers)
+
+
+def not_modified_headers(etag, last_modified):
+    """
+    Generate the headers of a 304 response for a file, cached together with its validators.
+    Parameters:
+        - etag: entity tag of the file
+        - last_modified: formatted modification time of the file
+    Returns:
+        The encoded headers following the Date header
+    """
+    return SERVER_HEADER + 'ETag: {etag}\r\nLast-Modified: {date}\r\n'.format(
+        etag=etag, date=last_modified).encode('latin-1') + KEEP_ALIVE_END
+
+
+def is_not_modified(headers, validator):
+    """
+    Evaluate the conditional headers of a GET or HEAD request against the validators of a file.
+    If-None-Match takes precedence over If-Modified-Since, invalid dates are ignored.
+    Parameters:
+        - headers: headers of the request
+        - validator: Validator of the requested file
+    Returns:
+        True if a 304 response should be sent
+    """
+    if 'If-None-Match' in headers:
+        for tag in headers['If-None-Match'].split(','):
+            tag = tag.strip()
+            for encoding in ENCODINGS:  # Tags of compressed representations validate the file as well
+                if tag.endswith('-' + encoding + '"'):
+                    tag = tag[:-len(encoding) - 2] + '"'
+            if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == validator.etag:
+                return True
+        return False
+    if 'If-Modified-Since' in headers:
+        since = headers['If-Modified-Since']
+        if since == validator.last_modified:
+            return True  # Clients echo Last-Modified, which needs no parsing
+        try:
+            since = calendar.timegm(time.strptime(since, "%a, %d %b %Y %H:%M:%S GMT"))
+        except ValueError:
+            return False
+        return int(validator.mtime) <= since
+    return False
+
+
+def if_range_matches(value, etag, last_modified):
+    """
+    Evaluate the If-Range header of a range request: the range is only served if the file is still the one the
+    client holds part of, otherwise the whole file is sent.
+    Parameters:
+        - value: value of the If-Range header, an entity tag or an HTTP date
+        - etag: entity tag of the file
+        - last_modified: formatted modification time of the file
+    Returns:
+        True if the range should be served
+    """
+    value = value.strip()
+    if value.startswith('"'):
+        return value == etag  # Strong comparison
+    if value.startswith('W/'):
+        return False  # Weak tags never validate a range
+    return value == last_modified  # Dates only match exactly
+
+
+def parse_range(value, size):
+    """
+    Parse the Range header of a request for a file.
+    Parameters:
+        - value: value of the Range header
+        - size: size of the requested file
+    Returns:
+        A tuple with the first and last (inclusive) byte to serve, or None to serve the whole file
+    Raises:
+        ValueError if the range can not be satisfied
+    """
+    unit, _, byte_range = value.strip().partition('=')
+    first, dash, last = byte_range.strip().partition('-')
+    if unit != 'bytes' or not dash or ',' in byte_range:
+        return None  # Only a single byte range is supported, ignore anything else
+    first, last = first.strip(), last.strip()
+    if not (first.isdigit() or first == '') or not (last.isdigit() or last == '') or first == last == '':
+        return None  # Syntactically invalid ranges are ignored
+    if first == '':  # Suffix range: the last bytes of the file
+        if int(last) == 0 or size == 0:
+            raise ValueError('Range not satisfiable')
+        return max(size - int(last), 0), size - 1
+    if last and int(first) > int(last):
+        return None
+    if int(first) >= size:
+        raise ValueError('Range not satisfiable')
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def limit_connections(max_connections):
+    """
+    Caps the number of concurrent connections so they cannot run the process out of file descriptors, raising its
+    soft descriptor limit towards the hard limit first if it is too low
+    Parameters:
+        - max_connections: requested maximum number of concurrent connections
+    Returns:
+        The maximum number of concurrent connections the process can hold
+    """
+    if resource is None:
+        return max_connections
+    needed = max_connections * FDS_PER_CONNECTION + RESERVED_FDS
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        raised = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (raised, hard))
+            soft = raised
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY or soft >= needed:
+        return max_connections
+    limited = max((soft - RESERVED_FDS) // FDS_PER_CONNECTION, 1)
+    print("Limiting connections to {n}, the process may open {soft} files".format(n=limited, soft=soft))
+    return limited
+
+
+class FileResponse(object):
+    """
+    Response whose body is streamed from an open file instead of being held in memory
+    """
+
+    def __init__(self, header, file, offset, count):
+        self.header = header  # Encoded response headers
+        self.file = file  # File opened in binary mode, closed once the body is sent
+        self.offset = offset  # Position of the first byte of the body in the file
+        self.count = count  # Number of bytes to send
+
+
+def close_after(response):
+    """
+    Rewrites a built keep-alive response to announce that the connection is closed after it
+    Parameters:
+        - response: encoded response or FileResponse
+    Returns:
+        The rewritten response
+    """
+    if isinstance(response, FileResponse):
+        response.header = response.header.replace(KEEP_ALIVE_END, CLOSE_END, 1)
+        return response
+    return response.replace(KEEP_ALIVE_END, CLOSE_END, 1)  # The headers come first, so this never touches the body
+
+
+def send_vectored(sock, views):
+    """
+    Sends the first buffers of a queue with a single scatter/gather write and drops the bytes that were sent, so a
+    partial write resumes where it stopped
+    Parameters:
+        - sock: socket to write to
+        - views: deque of non-empty memoryviews, modified in place
+    Returns:
+        The number of bytes sent
+    """
+    if hasattr(sock, 'sendmsg'):
+        sent = sock.sendmsg(list(itertools.islice(views, IOV_MAX)))
+    else:  # Windows has no sendmsg
+        sent = sock.send(views[0])
+    remaining = sent
+    while remaining:
+        if len(views[0]) > remaining:
+            views[0] = views[0][remaining:]
+            break
+        remaining -= len(views.popleft())
+    return sent
+
+
+def send_responses(sock, responses):
+    """
+    Writes responses in order on a blocking socket, gathering consecutive in-memory responses into as few writes
+    as possible and streaming files with sendfile
+    Parameters:
+        - sock: socket to write to
+        - responses: encoded responses or FileResponses
+    Raises:
+        ConnectionAbortedError if a streamed file is shorter than announced, the connection must then be closed
+    """
+    views = deque()
+    for response in responses:
+        if isinstance(response, FileResponse):
+            with response.file:
+                views.append(memoryview(response.header))
+                while views:
+                    send_vectored(sock, views)
+                # Uses os.sendfile where available and falls back to chunked reads otherwise
+                if sock.sendfile(response.file, response.offset, response.count) != response.count:
+                    raise ConnectionAbortedError('File was truncated while streaming it')
+        elif response:
+            views.append(memoryview(response))
+    while views:
+        send_vectored(sock, views)
+
+
+def describe_response(response):
+    """
+    Extracts the status code and length of a built response, for logging and metrics.
+    Parameters:
+        - response: encoded response or FileResponse
+    Returns:
+        A tuple of the status code and the number of bytes of the response
+    """
+    if isinstance(response, FileResponse):
+        return int(response.header[9:12]), len(response.header) + response.count
+    return int(response[9:12]), len(response)  # Every status line starts with 'HTTP/1.1 '
 
 
 class WebServer(object):
@@ -40,18 +369,102 @@ class WebServer(object):
     Class for describing simple HTTP server objects
     """
 
-    def __init__(self, port=8000):
+    ENGINES = ('threaded', 'selector')
+    PACKET_SIZE = 64 * 1024  # Maximum number of bytes read from a client at once
+    LINGER = 2  # Seconds input is discarded after a response that closes the connection, before closing it
+    ACCEPT_BACKOFF = 0.1  # Seconds accepting pauses after the process ran out of descriptors or memory
+    WORKER_STABLE = 10  # Seconds a worker has to run for its exit to count as a crash rather than a failed start
+    RESTART_DELAY = 0.5  # Seconds before restarting a worker that failed to start, doubled on every failure
+    MAX_RESTART_DELAY = 30
+
+    def __init__(self, port=8000, engine='threaded', workers=1, cache_size=64 * 1024 * 1024,
+                 stream_threshold=1024 * 1024, access_log='access.log', hash_etags=False,
+                 compress_cache_size=16 * 1024 * 1024, max_connections=1024, backlog=128, keep_alive_timeout=10,
+                 max_requests=100, header_timeout=10, trace=None):
+        if engine not in self.ENGINES:
+            raise ValueError("Unknown engine '{e}', expected one of {engines}".format(e=engine, engines=self.ENGINES))
         self.s = None
         self.host = 'localhost'  # Default to any available network interface
         self.port = port
         self.content_dir = 'web'  # Directory where webpage files are stored
+        self.engine = engine  # 'threaded' starts a thread per client, 'selector' multiplexes them on one loop
+        self.timeout = keep_alive_timeout  # Seconds a client may stay idle before its connection is dropped
+        self.header_timeout = header_timeout  # Seconds a client may take to send the line and headers of a request
+        self.max_connections = limit_connections(max_connections)  # Further connections get a 503 and are closed
+        self.max_requests = max_requests  # Requests served per connection before it is closed, 0 for no limit
+        self.backlog = backlog  # Connections the kernel queues while they wait to be accepted
+        self.trace = trace  # File the timings of request phases are written to on exit, None to not record them
+        self.workers = workers or multiprocessing.cpu_count()  # Number of pre-forked processes, 0 for one per CPU
+        self.cache_size = cache_size  # Byte budget of the in-memory file cache, 0 disables it
+        self.stream_threshold = stream_threshold  # Files larger than this are streamed from disk with sendfile
+        self.router = Router(self.content_dir)  # Map of the files under content_dir, refreshed when it changes
+        self.validators = ValidatorIndex(self.content_dir, not_modified_headers, http_date, hash_content=hash_etags)
+        self.file_cache = FileCache(lambda path, size, mtime: file_headers(path, size, mtime,
+                                                                           self.validators.etag(path, size, mtime)),
+                                    max_bytes=cache_size, max_file_size=stream_threshold)
+        self.compressed_cache = CompressedCache(  # Compressed files, 0 disables compression
+            lambda path, length, entry, encoding: file_headers(
+                path, length, entry.mtime, self.validators.etag(path, entry.size, entry.mtime), encoding),
+            max_bytes=compress_cache_size)
+        self.access_log = AccessLog(access_log)  # Written by a background thread, None disables it
+        self.metrics = Metrics()  # Counters and latency histograms served on /metrics, per process
+        self.uploads = UploadStore()  # Commits POST and PUT bodies that were streamed to temporary files
+        self.reuse_port = False  # Bind with SO_REUSEPORT so sibling workers can share the port
+        self._worker_processes = []
+        self._running = False
+        if trace:
+            self._instrument()
+
+    def _instrument(self):
+        """
+        Enables tracing and wraps the phases of a request in spans, so they cost nothing while tracing is disabled
+        """
+        TRACER.enable()
+        module = sys.modules[__name__]
+        TRACER.instrument(RequestParser, 'feed', 'parse')
+        TRACER.instrument(self, '_handle_request', 'handle', lambda request: request.target)
+        TRACER.instrument(self.file_cache, 'get', 'read', lambda filepath: filepath)
+        TRACER.instrument(self.compressed_cache, 'get', 'compress', lambda filepath, entry, encoding: encoding)
+        TRACER.instrument(self.uploads, 'append', 'upload')
+        TRACER.instrument(self.uploads, 'store', 'upload')
+        if self.engine == 'selector':
+            TRACER.instrument(module, 'send_vectored', 'send')
+            TRACER.instrument(_Connection, 'send_file_chunk', 'send')
+        else:
+            TRACER.instrument(module, 'send_responses', 'send')
 
     def start(self):
         """
         Attempts to create and bind a socket to launch the server
         """
+        if self.workers > 1:
+            self._start_workers()  # Serve from pre-forked worker processes instead
+            return
+        if self.s is None:  # Workers may be given the listening socket of the master
+            self._bind()
+        self.router.build()
+        self.validators.build()
+
+        try:
+            if self.engine == 'selector':
+                self._listen_selector()  # Serve all connections from a single event loop
+            else:
+                self._listen()  # Start listening for connections
+        finally:
+            self.access_log.close()  # Write the lines still queued
+            self.uploads.close()
+            if self.trace:
+                TRACER.write(self.trace)
+                print("Trace written to {path}".format(path=self.trace))
+
+    def _bind(self):
+        """
+        Creates the server socket and binds it to self.port, exiting if the port is unavailable
+        """
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.reuse_port:
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         try:
             print("Starting server on {host}:{port}".format(host=self.host, port=self.port))
@@ -63,159 +476,774 @@ class WebServer(object):
             self.shutdown()
             sys.exit(1)
 
-        self._listen()  # Start listening for connections
-
     def shutdown(self):
         """
-        Shuts down the server
+        Shuts down the server and terminates its worker processes
         """
+        print("Shutting down server")
+        self._running = False
+        for worker in self._worker_processes:
+            worker.terminate()  # Workers stop accepting and let open connections finish
+        for worker in self._worker_processes:
+            worker.join(self.timeout)
+            if worker.is_alive():
+                worker.kill()
+        self._worker_processes = []
         try:
-            print("Shutting down server")
-            self.s.shutdown(socket.SHUT_RDWR)
+            if self.s is not None:
+                self.s.shutdown(socket.SHUT_RDWR)
 
         except socket.error:
             pass  # Pass if socket is already closed
 
+    def _start_workers(self):
+        """
+        Runs the master process: starts self.workers worker processes and restarts any that exit until shutdown()
+        is called, waiting longer and longer before restarting workers that keep exiting right after they start
+        """
+        if sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT'):
+            # Every worker binds its own socket and Linux balances connections between them
+            self.reuse_port = True
+            self._bind()  # Fail early if the port is unavailable
+            self.s.close()
+            self.s = None
+        else:
+            # Elsewhere SO_REUSEPORT is missing or does not balance connections (macOS, BSD), so the workers accept
+            # from the listening socket of the master, which multiprocessing passes to them with fork and spawn
+            self._bind()
+            self.s.listen(self.backlog)
+        context = multiprocessing.get_context()
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+        self._running = True
+        self._worker_processes = [self._spawn_worker(context) for _ in range(self.workers)]
+        started = [time.monotonic()] * self.workers  # When the worker of every slot was started
+        failures = [0] * self.workers  # Exits in a row of the workers of a slot that did not run for long
+        restarts = [None] * self.workers  # When the exited worker of a slot is started again, None while it runs
+        try:
+            while self._running:
+                now = time.monotonic()
+                timeout = min([1.0] + [max(at - now, 0) for at in restarts if at is not None])
+                sentinels = [w.sentinel for w, at in zip(self._worker_processes, restarts) if at is None]
+                if sentinels:
+                    multiprocessing.connection.wait(sentinels, timeout=timeout)
+                else:
+                    time.sleep(timeout)
+                now = time.monotonic()
+                for i, worker in enumerate(self._worker_processes):
+                    if not self._running:
+                        break
+                    if restarts[i] is None and not worker.is_alive():
+                        # Restart at once after a crash, but back off from a worker that keeps failing at startup
+                        failures[i] = failures[i] + 1 if now - started[i] < self.WORKER_STABLE else 0
+                        delay = min(self.RESTART_DELAY * 2 ** (failures[i] - 1), self.MAX_RESTART_DELAY) \
+                            if failures[i] else 0
+                        restarts[i] = now + delay
+                        print("Worker {pid} exited with code {code}, restarting in {delay:.1f} s".format(
+                            pid=worker.pid, code=worker.exitcode, delay=delay))
+                    if restarts[i] is not None and now >= restarts[i]:
+                        self._worker_processes[i] = self._spawn_worker(context)
+                        started[i], restarts[i] = now, None
+        except KeyboardInterrupt:
+            pass
+        if self._running:
+            self.shutdown()
+
+    def _spawn_worker(self, context):
+        """
+        Starts a single worker process
+        Parameters:
+            - context: multiprocessing context to start the process with
+        Returns:
+            The started process
+        """
+        options = dict(port=self.port, engine=self.engine, cache_size=self.cache_size,
+                       stream_threshold=self.stream_threshold, access_log=self.access_log.path,
+                       hash_etags=self.validators.hash_content,
+                       compress_cache_size=self.compressed_cache.max_bytes, max_connections=self.max_connections,
+                       backlog=self.backlog, keep_alive_timeout=self.timeout, max_requests=self.max_requests,
+                       header_timeout=self.header_timeout, trace=self.trace)
+        worker = context.Process(target=_run_worker, args=(options, self.s), daemon=True)
+        worker.start()
+        return worker
+
     def _listen(self):
         """
         Listens on self.port for any incoming connections
         """
-        self.s.listen()
+        self.s.listen(self.backlog)
         while True:
-            (client, address) = self.s.accept()
-            client.settimeout(10)
-            print("Received connection from {address}".format(address=address))
-            threading.Thread(target=self._handle_client, args=(client,)).start()
+            try:
+                (client, address) = self.s.accept()
+            except OSError as error:
+                if not self._accept_failed(error):
+                    raise
+                if error.errno in ACCEPT_RESOURCE_ERRORS:
+                    time.sleep(self.ACCEPT_BACKOFF)
+                continue
+            if self.metrics.active_connections >= self.max_connections:
+                self._shed(client)
+                continue
+            self.metrics.count_connection('accepted')
+            threading.Thread(target=self._handle_client, args=(client, address)).start()
+
+    def _accept_failed(self, error):
+        """
+        Counts an error of accept() that the server survives: the process ran out of descriptors or memory, or the
+        client reset the connection before it was accepted
+        Parameters:
+            - error: OSError raised by accept()
+        Returns:
+            Whether accepting can continue, False for other errors such as a closed listening socket
+        """
+        if error.errno not in ACCEPT_RESOURCE_ERRORS and error.errno != errno.ECONNABORTED:
+            return False
+        self.metrics.count_connection('accept_error')
+        return True
 
-    def _handle_client(self, client):
+    def _shed(self, client):
         """
-        Main loop for handling connecting clients, serving files from content_dir and modifying files
+        Answers a connection accepted while the server is at capacity with a 503 and closes it, without reading
+        its request
         Parameters:
             - client: socket client from accept()
         """
-        PACKET_SIZE = 1024
-        while True:
-            try:
-                data = client.recv(PACKET_SIZE).decode()  # Receive data packet from client and decode
-                if not data:
-                    break
-                request_method = data.split(' ')[0]
-                print("Method: {m}".format(m=request_method))
-                if request_method == "GET" or request_method == "HEAD":
-                    headers = parse_headers(data, client=False, server=True)
-
-                    if 'Host' not in headers or self.host not in headers['Host']:
-                        if 'HTTP/1.1' in data:
-                            response_data = b""
-                            if request_method == "GET":  # Temporary 404 Response Page
-                                response_data = b"<html><body><center><h1>Error 400: Bad Request</h1><img " \
-                                                b"src='https://http.cat/400'></center></body></html> "
-                            response_header = generate_headers(400, len(response_data))
-                            response = response_header.encode()
-                            response += response_data
-                            client.send(response)
-                            break
-
-                    file_requested = data.split(' ')[1]
-                    file_requested = file_requested.split('?')[0]
-
-                    if file_requested == "/":
-                        file_requested = "/index.html"
-                    elif '.' not in file_requested:
-                        file_requested += '.html'
-
-                    filepath_to_serve = self.content_dir + file_requested
-                    print("Serving web page [{fp}]".format(fp=filepath_to_serve))
-                    print(threading.current_thread().name)
-                    # Check modified since header
-                    if 'If-Modified-Since' in headers.keys():
-                        last_m_time = path.getmtime('./web' + file_requested)
-                        utc_time = datetime.strptime(headers['If-Modified-Since'][2:], "%a, %d %b %Y %H:%M:%S GMT")
-                        required_time = (utc_time - datetime(1970, 1, 1)).total_seconds()
-                        if last_m_time <= required_time:
-                            response_header = generate_headers(304)
-                            client.send(response_header.encode())
-                            break
-                    # Load and Serve files content
+        self.metrics.count_connection('shed')
+        response_data = b"<html><body><center><h1>Error 503: Service Unavailable</h1><img " \
+                        b"src='https://http.cat/503'></center></body></html> "
+        try:
+            client.setblocking(False)  # The response fits in the send buffer of a new connection
+            client.send(generate_headers(503, len(response_data), {'Retry-After': 1}, keep_alive=False) +
+                        response_data)
+            client.shutdown(socket.SHUT_WR)
+            client.recv(self.PACKET_SIZE)  # Consume a request that already arrived, so close() does not reset
+        except socket.error:
+            pass
+        client.close()
+
+    def _timed_out(self, client, receiving_head):
+        """
+        Records a connection dropped for inactivity, telling a client that stalled in the middle of its request
+        headers with a 408
+        Parameters:
+            - client: socket client of the connection
+            - receiving_head: whether part of a request line or its headers was received
+        """
+        if not receiving_head:
+            self.metrics.count_connection('idle_timeout')
+            return
+        self.metrics.count_connection('header_timeout')
+        try:
+            client.setblocking(False)
+            client.send(generate_headers(408, keep_alive=False))
+        except socket.error:
+            pass
+
+    def _handle_request(self, request):
+        """
+        Handles a single request from a client, serving files from content_dir and modifying files
+        Parameters:
+            - request: Request parsed from the data received from the client
+        Returns:
+            A tuple of the encoded response and whether the connection should be kept alive
+        """
+        request_method = request.method
+        if request_method == "GET" or request_method == "HEAD":
+            headers = request.headers
+
+            if 'Host' not in headers or self.host not in headers['Host']:
+                if request.version == 'HTTP/1.1':
                     response_data = b""
-                    response_length = 0
-                    try:
-                        f = open(filepath_to_serve, 'rb')
-                        if request_method == "GET":  # Read only for GET
-                            response_data = f.read()
-                            response_length = len(response_data)
-                        f.close()
-                        response_header = generate_headers(200, response_length)
-
-                    except FileNotFoundError:
-                        print("File not found. Serving 404 page.")
-                        response_header = generate_headers(404, 119)
-                        if request_method == "GET":  # Temporary 404 Response Page
-                            response_data = b"<html><body><center><h1>Error 404: File not found</h1><img " \
-                                            b"src='http://localhost:8000/404.jpg'></center></body></html> "
-                    response = response_header.encode()
-                    if request_method == "GET":
-                        response += response_data
-                    client.send(response)
-                elif request_method == "POST":
-                    body = data.split('\r\n\r\n')[1]
-                    file_requested = data.split(' ')[1]
-                    if file_requested == "/":
-                        file_requested = "/index.txt"
-                    filepath_to_serve = self.content_dir + file_requested
+                    if request_method == "GET":  # Temporary 404 Response Page
+                        response_data = b"<html><body><center><h1>Error 400: Bad Request</h1><img " \
+                                        b"src='https://http.cat/400'></center></body></html> "
+                    response_header = generate_headers(400, len(response_data), keep_alive=False)
+                    return response_header + response_data, False
+
+            if request.target.split('?')[0] == '/metrics':
+                response_data = self.metrics.render()
+                response = generate_headers(200, len(response_data), {'Content-Type': 'text/plain; version=0.0.4'})
+                return response + (response_data if request_method == "GET" else b""), True
+            try:
+                route = self.router.resolve(request.target)
+            except ValueError:  # Malformed, or escapes content_dir with '..'
+                return self._bad_request(request_method), False
+            if route is None:
+                return self._not_found(request_method), True
+
+            filepath_to_serve = route.path
+            # Answer conditional requests from the validator index, without opening the file
+            if 'If-None-Match' in headers or 'If-Modified-Since' in headers:
+                validator = self.validators.get(filepath_to_serve)
+                if validator is not None and is_not_modified(headers, validator):
+                    return generate_status(304) + validator.headers, True
+            # Serve files content from the cache, or stream it from disk if it is too large to cache
+            try:
+                entry = self.file_cache.get(filepath_to_serve)
+                encoding = None
+                if 'Accept-Encoding' in headers and 'Range' not in headers and entry.data is not None \
+                        and self.compressed_cache.max_bytes \
+                        and is_compressible(route.content_type):
+                    encoding = negotiate(headers['Accept-Encoding'])
+                if encoding is not None:
+                    compressed = self.compressed_cache.get(filepath_to_serve, entry, encoding)
+                    response_header = generate_status(200) + compressed.headers
+                    return response_header + (compressed.data if request_method == "GET" else b""), True
+                byte_range = None
+                if 'Range' in headers and ('If-Range' not in headers or if_range_matches(
+                        headers['If-Range'], self.validators.etag(filepath_to_serve, entry.size, entry.mtime),
+                        http_date(entry.mtime))):
                     try:
-                        f = open(filepath_to_serve, 'a')
-                        f.write(body)
-                        f.close()
-                        response_header = generate_headers(200)
-                        client.send(response_header.encode())
-                        break
-                    except Exception as e:
-                        response_data = b"<html><body><center><h1>Error 500: Server Error</h1>" + b"<h2>" +\
-                                        str(e).encode() + b"</h2><img src='https://http.cat/500'></center></body" \
-                                        b"></html> "
-                        response_header = generate_headers(500, len(response_data))
-                        response = response_header.encode() + response_data
-                        client.send(response)
-                        print(e)
+                        byte_range = parse_range(headers['Range'], entry.size)
+                    except ValueError:
+                        response_header = generate_headers(416, 0, {'Content-Range': 'bytes */{size}'.format(
+                            size=entry.size)})
+                        return response_header, True
+                if byte_range is None:
+                    offset, count = 0, entry.size
+                    response_header = generate_status(200) + entry.headers
+                else:
+                    offset, count = byte_range[0], byte_range[1] - byte_range[0] + 1
+                    response_header = generate_headers(206, count, {
+                        'Accept-Ranges': 'bytes',
+                        'Content-Range': 'bytes {first}-{last}/{size}'.format(first=byte_range[0], last=byte_range[1],
+                                                                           size=entry.size)})
+                if request_method == "HEAD":
+                    response = response_header
+                elif entry.data is not None:
+                    response = response_header + entry.data[offset:offset + count]
+                else:
+                    response = FileResponse(response_header, open(filepath_to_serve, 'rb'), offset, count)
+
+            except FileNotFoundError:  # Removed since the file map was refreshed
+                response = self._not_found(request_method)
+            return response, True
+        elif request_method == "POST":
+            try:
+                url_path = self._post_path(request.target)
+            except ValueError:
+                RequestParser.discard([request])
+                return self._bad_request(request_method), False
+            filepath_to_serve = self.content_dir + url_path
+            try:
+                if request.upload is not None:
+                    self.uploads.append(request.upload, filepath_to_serve)
+                else:
+                    with open(filepath_to_serve, 'ab') as f:
+                        f.write(request.body)
+                self.file_cache.invalidate(filepath_to_serve)
+                self.validators.update(filepath_to_serve)
+                self.router.add(url_path)
+                response_header = generate_headers(200, keep_alive=False)
+                return response_header, False
+            except Exception as e:
+                response_data = b"<html><body><center><h1>Error 500: Server Error</h1>" + b"<h2>" +\
+                                str(e).encode() + b"</h2><img src='https://http.cat/500'></center></body" \
+                                b"></html> "
+                response_header = generate_headers(500, len(response_data), keep_alive=False)
+                response = response_header + response_data
+                print(e)
+                return response, False
+        elif request_method == "PUT":
+            name = time.strftime("%d %b %Y %H-%M-%S", time.localtime())
+            try:
+                if request.upload is None:
+                    request.upload = Upload(self.content_dir)
+                    request.upload.write(request.body)
+                file_name = self.uploads.store(request.upload, self.content_dir, name)
+                self.validators.update(self.content_dir + '/' + file_name)
+                self.router.add('/' + file_name)
+                response_header = generate_headers(200, extra_headers={'Content-Location': '/' + quote(file_name)})
+            except Exception as e:
+                response_data = b"<html><body><center><h1>Error 500: Server Error</h1>" + b"<h2>" + \
+                                str(e).encode() + b"</h2><img src='https://http.cat/500'></center></body" \
+                                                  b"></html> "
+                response_header = generate_headers(500, len(response_data), keep_alive=False)
+                response = response_header + response_data
+                print(e)
+                return response, False
+            return response_header, True
+        else:
+            response_data = b"<html><body><center><h1>Error 400: Bad Request</h1><img " \
+                            b"src='https://http.cat/400'></center></body></html> "
+            response_header = generate_headers(400, len(response_data), keep_alive=False)
+            return response_header + response_data, False
+
+    def _post_path(self, target):
+        """
+        Returns the URL path of the file a POST to the given target appends to
+        Parameters:
+            - target: request target of the POST
+        Raises:
+            ValueError if the target is malformed or escapes content_dir
+        """
+        path = normalize(target)
+        return '/index.txt' if path == '/' else path
+
+    @staticmethod
+    def _bad_request(request_method):
+        """
+        Builds a 400 response that closes the connection
+        Parameters:
+            - request_method: method of the request, HEAD responses have no body
+        """
+        response_data = b""
+        if request_method != "HEAD":
+            response_data = b"<html><body><center><h1>Error 400: Bad Request</h1><img " \
+                            b"src='https://http.cat/400'></center></body></html> "
+        return generate_headers(400, len(response_data), keep_alive=False) + response_data
+
+    @staticmethod
+    def _not_found(request_method):
+        """
+        Builds a 404 response
+        Parameters:
+            - request_method: method of the request, HEAD responses have no body
+        """
+        response = generate_headers(404, 119, {'Content-Type': 'text/html; charset=utf-8'})
+        if request_method == "GET":  # Temporary 404 Response Page
+            response += b"<html><body><center><h1>Error 404: File not found</h1><img " \
+                        b"src='http://localhost:8000/404.jpg'></center></body></html> "
+        return response
+
+    def _upload_sink(self, request):
+        """
+        Called by the request parser once the headers of a request are parsed, so POST and PUT bodies are streamed
+        to a temporary file next to their destination instead of being kept in memory
+        Parameters:
+            - request: Request whose body is about to be received
+        Returns:
+            The Upload to write the body to, or a Discard for methods that do not use the body
+        """
+        if request.method == 'POST':
+            try:
+                return Upload(os.path.dirname(self.content_dir + self._post_path(request.target)))
+            except ValueError:
+                return Upload(self.content_dir)  # Discarded once the request is rejected
+        if request.method == 'PUT':
+            return Upload(self.content_dir)
+        return Discard()
+
+    def _respond(self, parser, packet, address, remaining=None):
+        """
+        Feeds a received packet to the parser of the connection and builds the responses of every request it
+        completes, turning errors into a 400 or 500 response, and records every request in the access log and metrics
+        Parameters:
+            - parser: RequestParser of the connection
+            - packet: raw bytes received from the client
+            - address: (host, port) of the client
+            - remaining: number of requests the connection may still make, None for no limit
+        Returns:
+            A tuple of the list of responses, in request order, and whether the connection should be kept alive
+        """
+        try:
+            requests = parser.feed(packet)
+        except ParseError:
+            response_data = b"<html><body><center><h1>Error 400: Bad Request</h1><img " \
+                            b"src='https://http.cat/400'></center></body></html> "
+            response = generate_headers(400, len(response_data), keep_alive=False) + response_data
+            self.metrics.observe('-', 400, len(response), 0.0)
+            self.access_log.log(address, '-', '-', '-', 400, len(response), 0.0)
+            return [response], False
+
+        responses = []
+        for request in requests:
+            started = time.perf_counter()
+            try:
+                response, keep_alive = self._handle_request(request)
+            except (socket.error, ValueError, IndexError) as error:
+                response, keep_alive = self._server_error(error), False
+            if keep_alive and remaining is not None and len(responses) + 1 >= remaining:
+                response, keep_alive = close_after(response), False  # Last request allowed on this connection
+                self.metrics.count_connection('max_requests')
+            duration = time.perf_counter() - started
+            status, length = describe_response(response)
+            self.metrics.observe(request.method, status, length, duration)
+            self.access_log.log(address, request.method, request.target, request.version, status, length, duration)
+            responses.append(response)
+            if not keep_alive:
+                parser.discard(requests[len(responses):])
+                return responses, False  # Requests pipelined after this one are dropped with the connection
+        return responses, True
+
+    def _continue(self, parser, address):
+        """
+        Answers a request that sent Expect: 100-continue and holds its body back until it is told to send it,
+        rejecting it right away if it would be rejected once its body arrived
+        Parameters:
+            - parser: RequestParser of the connection
+            - address: (host, port) of the client
+        Returns:
+            A tuple of the 100 Continue or final response, None if no request is waiting, and whether the connection
+            should be kept alive
+        """
+        request = parser.awaiting_continue()
+        if request is None:
+            return None, True
+        if request.method == 'POST':
+            try:
+                self._post_path(request.target)
+            except ValueError:
+                response = self._bad_request(request.method)
+                self.metrics.observe(request.method, 400, len(response), 0.0)
+                self.access_log.log(address, request.method, request.target, request.version, 400, len(response), 0.0)
+                return response, False  # The upload is aborted when the connection closes
+        return CONTINUE, True
+
+    @staticmethod
+    def _server_error(error):
+        """
+        Builds a 500 response describing the given error
+        Parameters:
+            - error: exception that caused the failure
+        Returns:
+            The encoded 500 response
+        """
+        e = str(error)
+        response_data = b"<html><body><center><h1>Error 500: Server Error</h1>" + b"<h2>" + e.encode() + \
+                        b"</h2><img src='https://http.cat/500'></center></body></html> "
+        response_header = generate_headers(500, len(response_data), keep_alive=False)
+        return response_header + response_data
+
+    def _handle_client(self, client, address):
+        """
+        Main loop for handling connecting clients on their own thread
+        Parameters:
+            - client: socket client from accept()
+            - address: (host, port) of the client
+        """
+        parser = RequestParser(body_sink=self._upload_sink)
+        served = 0  # Requests answered on this connection
+        keep_alive = True
+        head_started = None  # When the first bytes of a partially received request head arrived
+        try:
+            while True:
+                try:
+                    timeout = self.timeout
+                    if parser.receiving_head:
+                        head_started = head_started or time.monotonic()
+                        timeout = min(timeout, self.header_timeout - (time.monotonic() - head_started))
+                        if timeout <= 0:
+                            raise socket.timeout('Request headers took too long')
+                    else:
+                        head_started = None
+                    client.settimeout(timeout)
+                    with TRACER.span('recv'):  # Includes waiting for the next request on a keep-alive connection
+                        data = client.recv(self.PACKET_SIZE)  # Receive data packet from client
+                    if not data:
                         break
-                elif request_method == "PUT":
-                    body = data.split('\r\n\r\n')[1]
-                    name = time.strftime("%d %b %Y %H-%M-%S", time.localtime())
-                    filepath_to_serve = self.content_dir + '/' + name + '.txt'
-                    try:
-                        f = open(filepath_to_serve, 'w')
-                        f.write(body)
-                        f.close()
-                        response_header = generate_headers(200)
-                    except Exception as e:
-                        response_data = b"<html><body><center><h1>Error 500: Server Error</h1>" + b"<h2>" + \
-                                        str(e).encode() + b"</h2><img src='https://http.cat/500'></center></body" \
-                                                          b"></html> "
-                        response_header = generate_headers(500, len(response_data))
-                        response = response_header.encode() + response_data
-                        client.send(response)
-                        print(e)
+                    responses, keep_alive = self._respond(parser, data, address,
+                                                          self.max_requests - served if self.max_requests else None)
+                    served += len(responses)
+                    if keep_alive:
+                        interim, keep_alive = self._continue(parser, address)
+                        if interim is not None:
+                            responses.append(interim)
+                    client.settimeout(self.timeout)
+                    send_responses(client, responses)  # Answers to pipelined requests share writes
+                    if not keep_alive:
                         break
-                    client.send(response_header.encode())
-                else:
-                    response_data = b"<html><body><center><h1>Error 400: Bad Request</h1><img " \
-                                    b"src='https://http.cat/400'></center></body></html> "
-                    response_header = generate_headers(400, len(response_data))
-                    response = response_header.encode()
-                    response += response_data
-                    client.send(response)
+                except socket.timeout:
+                    self._timed_out(client, parser.receiving_head)
                     break
-            except socket.error as error:
-                e = str(error)
-                response_data = b"<html><body><center><h1>Error 500: Server Error</h1>" + b"<h2>" + e.encode() + \
-                                b"</h2><img src='https://http.cat/500'></center></body></html> "
-                response_header = generate_headers(500, len(response_data))
-                response = response_header.encode() + response_data
-                client.send(response)
-                break
+                except ConnectionError:
+                    break  # The client is gone, or a response was cut short and the connection cannot be reused
+                except socket.error as error:
+                    client.send(self._server_error(error))
+                    break
+        except socket.error:
+            pass  # The client is gone
+        finally:
+            if not keep_alive:
+                self._linger(client)
+            parser.abort()  # Removes the temporary file of an upload the client did not finish
+            client.close()
+            self.metrics.count_connection('closed')
+
+    def _linger(self, client):
+        """
+        Closes the sending side of a connection and discards what the client still sends for a moment, so the kernel
+        does not reset the connection over unanswered pipelined requests and drop responses that were not read yet
+        Parameters:
+            - client: socket client of the connection
+        """
+        deadline = time.monotonic() + self.LINGER
+        try:
+            client.shutdown(socket.SHUT_WR)
+            client.settimeout(self.LINGER)
+            while client.recv(self.PACKET_SIZE) and time.monotonic() < deadline:
+                pass
+        except socket.error:
+            pass
+
+    def _listen_selector(self):
+        """
+        Listens on self.port and multiplexes all connections on a single selector event loop
+        """
+        self.s.listen(self.backlog)
+        self.s.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.s, selectors.EVENT_READ)
+        last_sweep = time.monotonic()
+        paused_until = None  # While accepting backs off, the listening socket is not watched
+        while True:
+            timeout = 1 if paused_until is None else min(max(paused_until - time.monotonic(), 0), 1)
+            for key, events in selector.select(timeout=timeout):
+                if key.fileobj is self.s:
+                    if not self._accept(selector):
+                        selector.unregister(self.s)
+                        paused_until = time.monotonic() + self.ACCEPT_BACKOFF
+                elif events & selectors.EVENT_READ:
+                    self._read(selector, key.data)
+                elif events & selectors.EVENT_WRITE:
+                    self._write(selector, key.data)
+            now = time.monotonic()
+            if paused_until is not None and now >= paused_until:
+                selector.register(self.s, selectors.EVENT_READ)
+                paused_until = None
+            if now - last_sweep >= 1:  # Drop idle clients at most once per second
+                last_sweep = now
+                for key in list(selector.get_map().values()):
+                    conn = key.data
+                    if conn is None:
+                        continue
+                    if conn.lingering_since is not None:
+                        if now - conn.lingering_since > self.LINGER:
+                            self._close(selector, conn)
+                    elif conn.head_started is not None and now - conn.head_started > self.header_timeout:
+                        self._timed_out(conn.client, True)
+                        self._close(selector, conn)
+                    elif now - conn.last_active > self.timeout:
+                        self._timed_out(conn.client, False)
+                        self._close(selector, conn)
+
+    def _accept(self, selector):
+        """
+        Accepts a pending connection and registers it on the selector
+        Parameters:
+            - selector: selector of the event loop
+        Returns:
+            False if accepting should back off for a moment because the process ran out of resources
+        """
+        try:
+            (client, address) = self.s.accept()
+        except BlockingIOError:
+            return True  # Another event already took the connection
+        except OSError as error:
+            if not self._accept_failed(error):
+                raise
+            return error.errno not in ACCEPT_RESOURCE_ERRORS
+        if self.metrics.active_connections >= self.max_connections:
+            self._shed(client)
+            return True
+        self.metrics.count_connection('accepted')
+        client.setblocking(False)
+        selector.register(client, selectors.EVENT_READ, _Connection(client, address, self._upload_sink))
+        return True
+
+    def _read(self, selector, conn):
+        """
+        Reads a request packet from a readable client and queues its response
+        Parameters:
+            - selector: selector of the event loop
+            - conn: _Connection of the readable client
+        """
+        try:
+            with TRACER.span('recv'):
+                data = conn.client.recv(self.PACKET_SIZE)
+        except BlockingIOError:
+            return
+        except socket.error:
+            self._close(selector, conn)
+            return
+        if not data:
+            self._close(selector, conn)
+            return
+        if conn.lingering_since is not None:
+            return  # Discard requests that arrive after the connection was closed for sending
+        conn.last_active = time.monotonic()
+        responses, keep_alive = self._respond(conn.parser, data, conn.address,
+                                              self.max_requests - conn.served if self.max_requests else None)
+        conn.served += len(responses)
+        if keep_alive:
+            interim, keep_alive = self._continue(conn.parser, conn.address)
+            if interim is not None:
+                responses.append(interim)
+        if not conn.parser.receiving_head:
+            conn.head_started = None
+        elif conn.head_started is None or responses:
+            conn.head_started = conn.last_active
+        if not responses:
+            return  # Wait for the rest of the request
+        conn.queue.extend(responses)
+        conn.keep_alive = keep_alive
+        selector.modify(conn.client, selectors.EVENT_WRITE, conn)  # Stop reading until the response is out
+        self._write(selector, conn)
+
+    def _write(self, selector, conn):
+        """
+        Writes as much of the queued response as the client accepts
+        Parameters:
+            - selector: selector of the event loop
+            - conn: _Connection of the writable client
+        """
+        try:
+            if not conn.out and conn.file is None:
+                conn.next_responses()
+            if conn.out:
+                send_vectored(conn.client, conn.out)
+            elif conn.file is not None:
+                conn.send_file_chunk()
+        except BlockingIOError:
+            return
+        except socket.error:
+            self._close(selector, conn)
+            return
+        conn.last_active = time.monotonic()
+        if conn.out or conn.file is not None or conn.queue:
+            return  # Wait for the next EVENT_WRITE
+        if conn.keep_alive:
+            selector.modify(conn.client, selectors.EVENT_READ, conn)
+            return
+        try:
+            conn.client.shutdown(socket.SHUT_WR)  # Linger until the client closes too, see _linger
+        except socket.error:
+            self._close(selector, conn)
+            return
+        conn.lingering_since = time.monotonic()
+        selector.modify(conn.client, selectors.EVENT_READ, conn)
+
+    def _close(self, selector, conn):
+        """
+        Unregisters and closes a client connection
+        Parameters:
+            - selector: selector of the event loop
+            - conn: _Connection to close
+        """
+        selector.unregister(conn.client)
+        conn.client.close()
+        conn.parser.abort()
+        if conn.file is not None:
+            conn.file.close()
+        for response in conn.queue:
+            if isinstance(response, FileResponse):
+                response.file.close()
+        self.metrics.count_connection('closed')
+
+
+def _run_worker(options, listener):
+    """
+    Entry point of a pre-forked worker process
+    Parameters:
+        - options: keyword arguments to create the worker's WebServer with
+        - listener: listening socket shared by the master, None to bind with SO_REUSEPORT
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Only the master reacts to Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if options.get('trace'):  # Every worker writes its own file, e.g. trace.1234.json
+        root, extension = os.path.splitext(options['trace'])
+        options['trace'] = '{root}.{pid}{ext}'.format(root=root, pid=os.getpid(), ext=extension)
+    server = WebServer(**options)
+    server.s = listener
+    server.reuse_port = listener is None
+    server.start()
+
+
+class _Connection(object):
+    """
+    Per-client state kept by the selector engine
+    """
+
+    SEND_CHUNK = 256 * 1024  # Maximum number of file bytes sent per write event
+
+    def __init__(self, client, address, body_sink=None):
+        self.client = client
+        self.address = address
+        self.parser = RequestParser(body_sink=body_sink)
+        self.queue = deque()  # Responses waiting to be written, in request order
+        self.out = deque()  # Views on the response bytes waiting to be written, sent with one sendmsg
+        self.keep_alive = True  # Whether to keep reading after the queued response is written
+        self.last_active = time.monotonic()
+        self.served = 0  # Requests answered on this connection
+        self.head_started = None  # When the first bytes of a partially received request head arrived
+        self.lingering_since = None  # When the sending side was closed after the last response
+        self.file = None  # File whose body is streamed after the queued bytes
+        self.file_offset = 0
+        self.file_remaining = 0
+        self._buffer = None  # Read buffer for platforms without os.sendfile
+
+    def next_responses(self):
+        """
+        Starts writing the queued responses, up to and including the first one streamed from a file
+        """
+        while self.queue:
+            response = self.queue.popleft()
+            if isinstance(response, FileResponse):
+                self.out.append(memoryview(response.header))
+                self.file, self.file_offset, self.file_remaining = response.file, response.offset, response.count
+                return
+            if response:
+                self.out.append(memoryview(response))
+
+    def send_file_chunk(self):
+        """
+        Sends the next chunk of the streamed file, with os.sendfile where available
+        """
+        count = min(self.file_remaining, self.SEND_CHUNK)
+        if hasattr(os, 'sendfile'):
+            sent = os.sendfile(self.client.fileno(), self.file.fileno(), self.file_offset, count)
+        else:
+            if self._buffer is None:
+                self._buffer = bytearray(self.SEND_CHUNK)
+            view = memoryview(self._buffer)
+            self.file.seek(self.file_offset)
+            sent = self.client.send(view[:self.file.readinto(view[:count])])
+        if sent == 0:
+            raise ConnectionAbortedError('File was truncated while streaming it')
+        self.file_offset += sent
+        self.file_remaining -= sent
+        if self.file_remaining == 0:
+            self.file.close()
+            self.file = None
 
 
 if __name__ == '__main__':
-    server = WebServer()
+    parser = argparse.ArgumentParser(description='Simple HTTP server serving the web directory')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--engine', choices=WebServer.ENGINES, default='threaded',
+                        help='threaded: one thread per connection, selector: single event loop')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of pre-forked worker processes, 0 for one per CPU')
+    parser.add_argument('--cache-size', type=int, default=64 * 1024 * 1024,
+                        help='byte budget of the in-memory file cache, 0 to disable it')
+    parser.add_argument('--stream-threshold', type=int, default=1024 * 1024,
+                        help='files larger than this many bytes are streamed from disk instead of cached')
+    parser.add_argument('--access-log', default='access.log',
+                        help="file to write the access log to, an empty value disables it")
+    parser.add_argument('--hash-etags', action='store_true',
+                        help='derive ETags from a hash of the file content instead of its size and mtime')
+    parser.add_argument('--compress-cache-size', type=int, default=16 * 1024 * 1024,
+                        help='byte budget of the cache of gzip/brotli compressed files, 0 disables compression')
+    parser.add_argument('--max-connections', type=int, default=1024,
+                        help='concurrent connections per process, further connections get a 503')
+    parser.add_argument('--backlog', type=int, default=128, help='length of the queue of pending connections')
+    parser.add_argument('--keep-alive-timeout', type=float, default=10,
+                        help='seconds an idle keep-alive connection is kept open')
+    parser.add_argument('--max-requests', type=int, default=100,
+                        help='requests served per connection before it is closed, 0 for no limit')
+    parser.add_argument('--header-timeout', type=float, default=10,
+                        help='seconds a client may take to send the line and headers of a request')
+    parser.add_argument('--trace', default=None,
+                        help='record how long every phase of a request takes and write it to this file on exit, '
+                             'as a Chrome trace if it ends with .json and as folded flame graph stacks otherwise')
+    args = parser.parse_args()
+    server = WebServer(args.port, engine=args.engine, workers=args.workers, cache_size=args.cache_size,
+                       stream_threshold=args.stream_threshold, access_log=args.access_log or None,
+                       hash_etags=args.hash_etags, compress_cache_size=args.compress_cache_size,
+                       max_connections=args.max_connections, backlog=args.backlog,
+                       keep_alive_timeout=args.keep_alive_timeout, max_requests=args.max_requests,
+                       header_timeout=args.header_timeout, trace=args.trace)
+    if args.trace:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Write the trace when terminated too
     server.start()
@@ -0,0 +1,89 @@
+import bisect
+import threading
+
+
+class Metrics(object):
+    """
+    In-process request counters and latency histograms per method and status code
+    """
+
+    METHODS = ('GET', 'HEAD', 'POST', 'PUT')  # Any other method is counted as OTHER to bound the number of series
+    CONNECTION_EVENTS = ('accepted', 'closed', 'shed', 'idle_timeout', 'header_timeout', 'max_requests',
+                         'accept_error')
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self.bytes_sent = 0  # Total number of response bytes built
+        self.connections = dict.fromkeys(self.CONNECTION_EVENTS, 0)  # Event -> number of connections it happened to
+        self._series = dict()  # (method, status) -> [bucket counts..., +Inf count, sum of durations]
+        self._lock = threading.Lock()
+
+    def observe(self, method, status, length, duration):
+        """
+        Records a handled request
+        Parameters:
+            - method: request method
+            - status: status code of the response
+            - length: number of bytes of the response
+            - duration: seconds it took to build the response
+        """
+        if method not in self.METHODS:
+            method = 'OTHER'
+        bucket = bisect.bisect_left(self.BUCKETS, duration)
+        with self._lock:
+            series = self._series.get((method, status))
+            if series is None:
+                series = self._series[(method, status)] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += duration
+            self.bytes_sent += length
+
+    @property
+    def active_connections(self):
+        """
+        Number of connections that were accepted and are not closed yet
+        """
+        return self.connections['accepted'] - self.connections['closed']
+
+    def count_connection(self, event):
+        """
+        Records something that happened to a connection
+        Parameters:
+            - event: one of CONNECTION_EVENTS, 'shed' for connections refused with a 503 at capacity,
+                'accept_error' for accept() failures the server backed off from
+        """
+        with self._lock:
+            self.connections[event] += 1
+
+    def render(self):
+        """
+        Renders the metrics in the Prometheus text exposition format
+        Returns:
+            The encoded metrics
+        """
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+            bytes_sent = self.bytes_sent
+            connections = dict(self.connections)
+        lines = ['# TYPE http_requests_total counter']
+        for (method, status), values in series:
+            lines.append('http_requests_total{{method="{m}",status="{s}"}} {n}'.format(m=method, s=status,
+                                                                                       n=sum(values[:-1])))
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for (method, status), values in series:
+            labels = 'method="{m}",status="{s}"'.format(m=method, s=status)
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append('http_request_duration_seconds_bucket{{{labels},le="{le}"}} {n}'.format(
+                    labels=labels, le=bound, n=cumulative))
+            lines.append('http_request_duration_seconds_sum{{{labels}}} {t:.6f}'.format(labels=labels, t=values[-1]))
+            lines.append('http_request_duration_seconds_count{{{labels}}} {n}'.format(labels=labels, n=cumulative))
+        lines.append('# TYPE http_response_bytes_total counter')
+        lines.append('http_response_bytes_total {n}'.format(n=bytes_sent))
+        lines.append('# TYPE http_connections_total counter')
+        for event in self.CONNECTION_EVENTS:
+            lines.append('http_connections_total{{event="{e}"}} {n}'.format(e=event, n=connections[event]))
+        lines.append('# TYPE http_connections_active gauge')
+        lines.append('http_connections_active {n}'.format(n=connections['accepted'] - connections['closed']))
+        return ('\n'.join(lines) + '\n').encode()
@@ -0,0 +1,147 @@
+import mimetypes
+import os
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
+
+class Route(object):
+    """
+    A file that can be served, found by the path of its URL
+    """
+    __slots__ = ('path', 'content_type')
+
+    def __init__(self, path, content_type):
+        self.path = path  # Path of the file on disk
+        self.content_type = content_type  # MIME type guessed from the extension, None if unknown
+
+
+def normalize(target):
+    """
+    Turns a request target into a clean URL path: the query is dropped, percent-escapes are decoded once and
+    '.' and '..' segments are resolved
+    Parameters:
+        - target: request target, e.g. /images/a%20b.png?size=2
+    Returns:
+        The normalized path, starting with '/' and keeping a trailing '/'
+    Raises:
+        ValueError if the path is malformed or '..' would escape the content directory
+    """
+    path = target.split('?', 1)[0]
+    if not path.startswith('/'):
+        path = urlsplit(target).path  # Absolute form, e.g. http://localhost/index.html
+    if '%' in path:
+        path = unquote(path, errors='strict')
+    if not path.startswith('/') or '\x00' in path or '\\' in path:
+        raise ValueError('Invalid path: ' + repr(target))
+    if '/.' not in path and '//' not in path:
+        return path  # Already normalized, the common case
+    segments = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if not segments:
+                raise ValueError('Path escapes the content directory: ' + repr(target))
+            segments.pop()
+        elif segment and segment != '.':
+            segments.append(segment)
+    return '/' + '/'.join(segments) + ('/' if segments and path.endswith('/') else '')
+
+
+class Router(object):
+    """
+    Resolves request targets against an in-memory map of every file under a directory, so looking up an existing
+    or a missing file is a dictionary hit instead of file system calls
+    """
+
+    def __init__(self, root, refresh_interval=1.0):
+        """
+        Parameters:
+            - root: directory whose files are served
+            - refresh_interval: seconds between checks of the directories for added or removed files
+        """
+        self.root = root
+        self.refresh_interval = refresh_interval
+        self._routes = dict()  # URL path -> Route, replaced as a whole when the directory changes
+        self._directories = dict()  # Directory -> modification time when the map was built
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def build(self):
+        """
+        Maps every file under root, skipping hidden files such as uploads in progress
+        """
+        routes = dict()
+        directories = dict()
+        for directory, names, files in os.walk(self.root):
+            names[:] = [name for name in names if not name.startswith('.')]
+            try:
+                directories[directory] = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            prefix = directory[len(self.root):].replace(os.sep, '/') + '/'
+            for name in files:
+                if not name.startswith('.'):
+                    routes[prefix + name] = self._route(prefix + name)
+        self._routes, self._directories = routes, directories
+        self._checked_at = time.monotonic()
+
+    def _route(self, url_path):
+        return Route(self.root + url_path, mimetypes.guess_type(url_path)[0])
+
+    def resolve(self, target):
+        """
+        Finds the file a GET or HEAD request asks for, serving index.html for '/' and adding .html to paths
+        without an extension
+        Parameters:
+            - target: request target
+        Returns:
+            The Route of the file, or None if it does not exist
+        Raises:
+            ValueError if the target is malformed or escapes the content directory
+        """
+        path = normalize(target)
+        if path.endswith('/'):
+            path += 'index.html'
+        elif '.' not in path[path.rfind('/'):]:
+            path += '.html'
+        if time.monotonic() - self._checked_at >= self.refresh_interval:
+            self._refresh()
+        return self._routes.get(path)
+
+    def add(self, url_path):
+        """
+        Maps a file that was just written, so it is served without waiting for the next refresh
+        Parameters:
+            - url_path: normalized URL path of the file
+        Returns:
+            The Route of the file
+        """
+        route = self._routes.get(url_path)
+        if route is not None:
+            return route
+        route = self._route(url_path)
+        with self._lock:
+            routes = dict(self._routes)
+            routes[url_path] = route
+            self._routes = routes  # Readers always see a complete map
+        return route
+
+    def _refresh(self):
+        """
+        Rebuilds the map if a directory was modified, which happens when a file in it is added, removed or renamed
+        """
+        if not self._lock.acquire(blocking=False):
+            return  # Another thread is already checking
+        try:
+            self._checked_at = time.monotonic()
+            for directory, mtime in self._directories.items():
+                try:
+                    if os.stat(directory).st_mtime != mtime:
+                        break
+                except OSError:
+                    break
+            else:
+                return
+            self.build()
+        finally:
+            self._lock.release()
@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+_UMASK = os.umask(0)  # Read once at import, setting it is process-wide and not thread-safe
+os.umask(_UMASK)
+
+
+class Upload(object):
+    """
+    A request body being streamed to a temporary file in the directory of its destination
+    """
+
+    def __init__(self, directory):
+        """
+        Parameters:
+            - directory: directory the upload ends up in, the temporary file is created there so it can be linked
+        """
+        self.size = 0  # Number of body bytes received
+        self.error = None  # OSError raised while receiving, reported once the request is handled
+        self.temp_path = None
+        self._file = None
+        try:
+            fd, self.temp_path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=directory)
+            self._file = os.fdopen(fd, 'wb')
+            os.chmod(self.temp_path, 0o666 & ~_UMASK)  # mkstemp creates it as 0600, stored files get the usual mode
+        except OSError as error:
+            self.error = error  # The body is still read, so the connection stays in sync
+
+    def write(self, data):
+        self.size += len(data)
+        if self._file is None:
+            return
+        try:
+            self._file.write(data)
+        except OSError as error:
+            self.error = error
+            self.abort()
+
+    def close(self):
+        """
+        Closes the temporary file once the whole body was received
+        Raises:
+            The OSError that occurred while receiving, if any
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """
+        Discards the upload, for example when the client disconnects in the middle of it
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.temp_path is not None:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+            self.temp_path = None
+
+
+class Discard(object):
+    """
+    Body sink of requests whose body is not used, such as GET and HEAD, so it is read without being kept in memory
+    """
+
+    def __init__(self):
+        self.size = 0  # Number of body bytes received
+
+    def write(self, data):
+        self.size += len(data)
+
+
+class UploadStore(object):
+    """
+    Commits uploads: atomically links PUT bodies to unique names and appends POST bodies under a per-file lock
+    """
+
+    MAX_OPEN_FILES = 64  # Number of append handles kept open between POSTs
+
+    def __init__(self):
+        self._locks = dict()  # Path -> lock serializing appends to the file
+        self._files = OrderedDict()  # Path -> open append handle, least recently used first
+        self._lock = threading.Lock()
+
+    def append(self, upload, filepath):
+        """
+        Appends a received upload to a file, so concurrent POSTs to the same file never interleave
+        Parameters:
+            - upload: Upload whose body is complete
+            - filepath: file to append to, created if it does not exist
+        """
+        try:
+            upload.close()
+            key = os.path.normpath(filepath)
+            with self._lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+            with lock:  # Only held for the local copy, not while the body arrives over the network
+                target = self._append_handle(key)
+                with open(upload.temp_path, 'rb') as body:
+                    shutil.copyfileobj(body, target, 1024 * 1024)
+                target.flush()
+        finally:
+            upload.abort()  # Removes the temporary file
+
+    def store(self, upload, directory, name):
+        """
+        Moves a received upload into place under a name no other upload has, without a window in which a
+        partially written file is visible
+        Parameters:
+            - upload: Upload whose body is complete
+            - directory: directory to store the file in
+            - name: preferred file name without extension, ' (n)' is added if it is taken
+        Returns:
+            The name of the stored file
+        """
+        try:
+            upload.close()
+            for n in range(1000):
+                file_name = name + (' ({n})'.format(n=n) if n else '') + '.txt'
+                try:
+                    os.link(upload.temp_path, os.path.join(directory, file_name))  # Fails if the name is taken
+                    return file_name
+                except FileExistsError:
+                    continue
+            raise FileExistsError('No free file name for ' + name)
+        finally:
+            upload.abort()
+
+    def _append_handle(self, key):
+        """
+        Returns the cached append handle of a file, reopening it if the file was removed or replaced
+        Parameters:
+            - key: normalized path of the file
+        """
+        with self._lock:
+            handle = self._files.pop(key, None)
+        if handle is not None:
+            try:
+                if os.fstat(handle.fileno()).st_ino != os.stat(key).st_ino:
+                    raise FileNotFoundError(key)
+            except OSError:
+                handle.close()
+                handle = None
+        if handle is None:
+            handle = open(key, 'ab')
+        with self._lock:
+            self._files[key] = handle
+            for path in list(self._files)[:max(len(self._files) - self.MAX_OPEN_FILES, 0)]:
+                if not self._locks[path].locked():  # Never close a handle another thread is appending through
+                    self._files.pop(path).close()
+        return handle
+
+    def close(self):
+        """
+        Closes the cached append handles
+        """
+        with self._lock:
+            for handle in self._files.values():
+                handle.close()
+            self._files.clear()
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+import time
+
+
+def make_etag(size, mtime, digest=None):
+    """
+    Builds the ETag of a file from a hash of its content, or from its size and modification time
+    Parameters:
+        - size: size of the file
+        - mtime: modification time of the file
+        - digest: optional hex digest of the content
+    Returns:
+        The quoted entity tag
+    """
+    if digest is not None:
+        return '"{d}"'.format(d=digest)
+    return '"{size:x}-{mtime:x}"'.format(size=size, mtime=int(mtime * 1000000))
+
+
+class Validator(object):
+    """
+    The validators of a file: what conditional requests are compared against
+    """
+    __slots__ = ('size', 'mtime', 'etag', 'last_modified', 'headers', 'checked_at')
+
+    def __init__(self, size, mtime, etag, last_modified, headers):
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.last_modified = last_modified  # Formatted HTTP date, compared verbatim before parsing dates
+        self.headers = headers  # Encoded headers of a 304 response, following the status and Date lines
+        self.checked_at = time.monotonic()  # Last time the validator was compared with the file
+
+
+class ValidatorIndex(object):
+    """
+    Index of the validators of every file under a directory, built at startup and revalidated by stat
+    """
+
+    def __init__(self, root, header_builder, date_formatter, hash_content=False, revalidate_interval=1.0):
+        """
+        Parameters:
+            - root: directory whose files are indexed
+            - header_builder: function of an ETag and Last-Modified value returning the encoded 304 headers
+            - date_formatter: function formatting a modification time as an HTTP date
+            - hash_content: derive ETags from a hash of the content instead of the size and mtime
+            - revalidate_interval: seconds a validator is trusted before its file is stat'ed again
+        """
+        self.root = root
+        self.header_builder = header_builder
+        self.date_formatter = date_formatter
+        self.hash_content = hash_content
+        self.revalidate_interval = revalidate_interval
+        self._validators = dict()
+        self._lock = threading.Lock()
+
+    def build(self):
+        """
+        Indexes every file under root
+        """
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                self.update(os.path.join(directory, name))
+
+    def get(self, filepath):
+        """
+        Returns the validators of a file, stat'ing it at most once per revalidate_interval
+        Parameters:
+            - filepath: path of the file
+        Returns:
+            The Validator of the file, or None if it does not exist
+        """
+        key = os.path.normpath(filepath)
+        validator = self._validators.get(key)
+        if validator is not None and time.monotonic() - validator.checked_at < self.revalidate_interval:
+            return validator
+        return self.update(key)
+
+    def update(self, filepath):
+        """
+        Refreshes the validators of a file, for example after it was written to
+        Parameters:
+            - filepath: path of the file
+        Returns:
+            The Validator of the file, or None if it does not exist
+        """
+        key = os.path.normpath(filepath)
+        try:
+            stat = os.stat(key)
+        except OSError:
+            with self._lock:
+                self._validators.pop(key, None)
+            return None
+        validator = self._validators.get(key)
+        if validator is not None and validator.mtime == stat.st_mtime and validator.size == stat.st_size:
+            validator.checked_at = time.monotonic()
+            return validator
+        digest = self._hash(key) if self.hash_content else None
+        etag = make_etag(stat.st_size, stat.st_mtime, digest)
+        last_modified = self.date_formatter(stat.st_mtime)
+        validator = Validator(stat.st_size, stat.st_mtime, etag, last_modified,
+                              self.header_builder(etag, last_modified))
+        with self._lock:
+            self._validators[key] = validator
+        return validator
+
+    def etag(self, filepath, size, mtime):
+        """
+        Returns the ETag of a file as it was when it had the given size and modification time, refreshing its
+        validators if they were built before the file changed, so responses carry the tag conditional requests are
+        compared against
+        Parameters:
+            - filepath: path of the file
+            - size: size of the file
+            - mtime: modification time of the file
+        Returns:
+            The quoted entity tag
+        """
+        validator = self._validators.get(os.path.normpath(filepath))
+        if validator is None or validator.size != size or validator.mtime != mtime:
+            validator = self.update(filepath)
+        if validator is not None and validator.size == size and validator.mtime == mtime:
+            return validator.etag
+        return make_etag(size, mtime)  # The file changed again since the caller stat'ed it
+
+    @staticmethod
+    def _hash(filepath):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
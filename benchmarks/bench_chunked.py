@@ -0,0 +1,114 @@
+"""
+Benchmark of the client's chunked body decoding on multi-megabyte pages
+
+Compares the buffered pool.Connection reader followed by a single charset decode with the
+recv(6) based loop the client used before. Run from the repository root:
+python benchmarks/bench_chunked.py [megabytes]
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'HTTP_Client')]
+from pool import Connection  # noqa: E402
+
+CHUNK_SIZE = 0x1000  # Four hex digits, the previous decoder only handled size lines of exactly six bytes
+
+
+def build_page(megabytes: int) -> (bytes, bytes):
+    """
+    Build a chunked response with an ASCII page of the given size
+
+    :param megabytes:   The size of the page
+    :return:            A tuple of the encoded response and the page
+    """
+    line = b'<p>The quick brown fox jumps over the lazy dog, charset=utf-8 does not matter here.</p>\n'
+    page = (line * (megabytes * 1024 * 1024 // len(line) + 1))[:megabytes * 1024 * 1024]
+    response = bytearray(b'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n')
+    for start in range(0, len(page), CHUNK_SIZE):
+        chunk = page[start:start + CHUNK_SIZE]
+        response += b'%x\r\n' % len(chunk) + chunk + b'\r\n'
+    response += b'0\r\n\r\n'
+    return bytes(response), page
+
+
+def serve(response: bytes) -> socket.socket:
+    """
+    Send a response from a background thread
+
+    :param response:    The bytes to send
+    :return:            The receiving end of the connection
+    """
+    receiver, sender = socket.socketpair()
+    threading.Thread(target=lambda: (sender.sendall(response), sender.close()), daemon=True).start()
+    return receiver
+
+
+def buffered(response: bytes) -> str:
+    conn = Connection.__new__(Connection)  # Wrap the socketpair instead of connecting
+    conn.host, conn.port, conn.sock = 'localhost', 0, serve(response)
+    conn.buffer, conn.reusable, conn.requests, conn.head_received = bytearray(), True, 1, False
+    conn._scratch = memoryview(bytearray(Connection.PACKET_SIZE))
+    body = conn.read_response().body
+    conn.close()
+    return body.decode('utf-8')
+
+
+def legacy(response: bytes) -> str:
+    s = serve(response)
+
+    def read_and_decode(no_bytes, encoding):
+        body = s.recv(no_bytes).decode(encoding=encoding)
+        no_bytes -= len(body)
+        if no_bytes <= 0:
+            return body.strip('\r\n')
+        while no_bytes > 0:
+            new_text = s.recv(no_bytes).decode(encoding=encoding)
+            body += new_text
+            no_bytes -= len(new_text)
+        return body
+
+    def get_new_chunk_length(encoding):
+        a = s.recv(6).decode(encoding=encoding).split('\r\n')
+        next_length = int(a[0], 16)
+        return (0, '') if next_length == 0 else (next_length - len(a[1]), a[1])
+
+    head = b''
+    while b'\r\n\r\n' not in head:  # The previous client assumed the head and first chunk line came in one recv
+        head += s.recv(1)
+    size_line = b''
+    while not size_line.endswith(b'\r\n'):
+        size_line += s.recv(1)
+    body = read_and_decode(int(size_line, 16) + 2, 'utf-8')
+    next_length, extra_body = get_new_chunk_length('utf-8')
+    body += extra_body
+    while next_length != 0:
+        body += read_and_decode(next_length + 2, 'utf-8')
+        next_length, extra_body = get_new_chunk_length('utf-8')
+        body += extra_body
+    s.close()
+    return body
+
+
+def report(name, func, response, page):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        text = func(response)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    correct = text == page.decode()
+    print("{name:<28} {ms:9.1f} ms {mbs:8.1f} MB/s  correct: {ok}".format(
+        name=name, ms=best * 1000, mbs=len(page) / best / 1e6, ok=correct))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    chunked_response, expected = build_page(size)
+    print("{mb} MB page in {n} chunks".format(mb=size, n=len(expected) // CHUNK_SIZE))
+    report('buffered reader', buffered, chunked_response, expected)
+    report('previous recv(6) decoder', legacy, chunked_response, expected)
@@ -0,0 +1,58 @@
+"""
+Microbenchmark of the per-response cost of building HTTP_Server response headers
+
+Compares the precomputed status lines and once-per-second Date clock with the if/elif and
+strftime based builder the server used before. Run from the repository root:
+python benchmarks/bench_headers.py
+"""
+import os
+import sys
+import time
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'HTTP_Server')]
+from main import file_headers, generate_headers, generate_status  # noqa: E402
+
+CACHED_HEADERS = file_headers('web/index.html', 322, 1650553855.0)  # Built once per cache entry
+
+
+def legacy_generate_headers(response_code, length=0, extra_headers=None):
+    header = ''
+    if response_code == 200:
+        header += 'HTTP/1.1 200 OK\n'
+    elif response_code == 206:
+        header += 'HTTP/1.1 206 Partial Content\n'
+    elif response_code == 304:
+        header += 'HTTP/1.1 304 Not Modified\n'
+    elif response_code == 400:
+        header += 'HTTP/1.1 400 Bad Request\n'
+    elif response_code == 404:
+        header += 'HTTP/1.1 404 Not Found\n'
+    elif response_code == 416:
+        header += 'HTTP/1.1 416 Range Not Satisfiable\n'
+    elif response_code == 500:
+        header += 'HTTP/1.1 500 Server Error\n'
+    time_now = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime())
+    header += 'Date: {now}\n'.format(now=time_now)
+    header += 'Server: CN Assignment 1 O. Vandenryt\n'
+    header += 'Content-Length: {length}\n'.format(length=str(length))
+    if extra_headers:
+        for key, value in extra_headers.items():
+            header += '{key}: {value}\n'.format(key=key, value=value)
+    header += 'Connection: keep-alive\n\n'
+    return header.encode()
+
+
+def report(name, func, number=200000):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print("{name:<44} {ns:8.0f} ns/response".format(name=name, ns=best / number * 1e9))
+
+
+if __name__ == '__main__':
+    report('previous builder, 200 with Accept-Ranges',
+           lambda: legacy_generate_headers(200, 322, {'Accept-Ranges': 'bytes'}))
+    report('previous builder, 404', lambda: legacy_generate_headers(404, 119))
+    report('cached file headers, 200 with validators', lambda: generate_status(200) + CACHED_HEADERS)
+    report('generate_headers, 404', lambda: generate_headers(404, 119))
+    report('generate_headers, 304 with Connection: close', lambda: generate_headers(304, keep_alive=False))
@@ -0,0 +1,61 @@
+"""
+Microbenchmarks of func.RequestParser against the string based func.parse_headers
+
+Run from the repository root: python benchmarks/bench_parser.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from func import RequestParser, parse_headers  # noqa: E402
+
+REQUEST = (b"GET /a/b.html?x=1 HTTP/1.1\r\n"
+           b"Host: localhost:8000\r\n"
+           b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0\r\n"
+           b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8\r\n"
+           b"Accept-Language: en-US,en;q=0.5\r\n"
+           b"Accept-Encoding: gzip, deflate, br\r\n"
+           b"Connection: keep-alive\r\n"
+           b"If-Modified-Since: Mon, 16 Oct 2023 09:00:00 GMT\r\n"
+           b"\r\n")
+PIPELINED = REQUEST * 8
+SEGMENTS = [REQUEST[i:i + 64] for i in range(0, len(REQUEST), 64)]
+
+
+def old_single():
+    data = REQUEST.decode()
+    return data.split(' ')[0], data.split(' ')[1], parse_headers(data, client=False, server=True)
+
+
+def new_single(parser=RequestParser()):
+    return parser.feed(REQUEST)
+
+
+def old_pipelined():
+    # parse_headers can not separate pipelined requests, split them up front to compare the header work
+    return [old_single() for _ in range(8)]
+
+
+def new_pipelined(parser=RequestParser()):
+    return parser.feed(PIPELINED)
+
+
+def new_segmented(parser=RequestParser()):
+    for segment in SEGMENTS:
+        requests = parser.feed(segment)
+    return requests
+
+
+def report(name, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print("{name:<40} {us:8.2f} us/call".format(name=name, us=best / number * 1e6))
+
+
+if __name__ == '__main__':
+    number = 20000
+    report('parse_headers, single request', old_single, number)
+    report('RequestParser.feed, single request', new_single, number)
+    report('parse_headers, 8 requests', old_pipelined, number // 8)
+    report('RequestParser.feed, 8 pipelined requests', new_pipelined, number // 8)
+    report('RequestParser.feed, {n} x 64 byte segments'.format(n=len(SEGMENTS)), new_segmented, number)
@@ -0,0 +1,278 @@
+"""
+Load generator and latency benchmark for HTTP_Server/main.py
+
+Starts the WebServer on localhost with a copy of HTTP_Server/web, drives it with many concurrent
+keep-alive clients and reports requests/s and latency percentiles. Run from the repository root:
+
+    python benchmarks/bench_server.py --connections 200 --duration 10 --output results.json
+    python benchmarks/bench_server.py --server-args "--engine selector --workers 4"
+
+Results are written as JSON so runs before and after a change can be compared.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVER_DIR = os.path.join(ROOT, 'HTTP_Server')
+
+DEFAULT_MIX = 'get=70,head=10,ims=10,404=6,post=2,put=2'
+FILES = ['/', '/a/b', '/200.jpg', '/400.jpg', '/404.jpg']
+FUTURE_DATE = 'Fri, 01 Jan 2100 00:00:00 GMT'  # Later than every file, so conditional GETs get a 304
+
+
+def parse_mix(mix: str) -> (list, list):
+    """
+    Parse a request mix such as get=70,head=10
+
+    :param mix:         Comma separated kind=weight pairs
+    :return:            A tuple of the kinds and their weights
+    """
+    kinds, weights = [], []
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('get', 'head', 'ims', '404', 'post', 'put'):
+            raise ValueError('Unknown request kind: ' + kind)
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def build_request(kind: str, port: int) -> bytes:
+    """
+    Build a request of the given kind
+
+    :param kind:        get, head, ims, 404, post or put
+    :param port:        The port of the server, for the Host header
+    :return:            The encoded request
+    """
+    host = 'Host: localhost:{port}\r\n'.format(port=port)
+    if kind == 'get':
+        return ('GET ' + random.choice(FILES) + ' HTTP/1.1\r\n' + host + '\r\n').encode()
+    if kind == 'head':
+        return ('HEAD ' + random.choice(FILES) + ' HTTP/1.1\r\n' + host + '\r\n').encode()
+    if kind == 'ims':
+        return ('GET ' + random.choice(FILES) + ' HTTP/1.1\r\n' + host + 'If-Modified-Since: ' + FUTURE_DATE +
+                '\r\n\r\n').encode()
+    if kind == '404':
+        return ('GET /missing-{n}.html HTTP/1.1\r\n'.format(n=random.randrange(1000)) + host + '\r\n').encode()
+    body = b'benchmark ' * 8
+    method = 'POST /bench.txt' if kind == 'post' else 'PUT /'
+    return (method + ' HTTP/1.1\r\n' + host + 'Content-Length: {n}\r\n\r\n'.format(n=len(body))).encode() + body
+
+
+async def read_response(reader: asyncio.StreamReader, head_only: bool) -> (int, bool):
+    """
+    Read one response framed by its Content-Length
+
+    :param reader:      The stream of the connection
+    :param head_only:   Whether the response answers a HEAD request
+    :return:            A tuple of the status code and whether the server will close the connection
+    """
+    status_line = await reader.readuntil(b'\n')
+    status = int(status_line.split(b' ')[1])
+    length, close = 0, False
+    while True:
+        line = (await reader.readuntil(b'\n')).strip()
+        if not line:
+            break
+        key, _, value = line.partition(b':')
+        key = key.strip().lower()
+        if key == b'content-length':
+            length = int(value)
+        elif key == b'connection' and value.strip().lower() == b'close':
+            close = True
+    if length and not head_only and status != 304:
+        await reader.readexactly(length)
+    return status, close
+
+
+async def client(port: int, kinds: list, weights: list, start: float, warmup_end: float, end: float, stats: dict):
+    """
+    Send requests over one keep-alive connection until end, reconnecting when the server closes it
+
+    :param port:        The port of the server
+    :param kinds:       The request kinds to choose from
+    :param weights:     The weights of the kinds
+    :param start:       Time to start sending at, so all clients start together
+    :param warmup_end:  Requests completed before this time are not recorded
+    :param end:         Time to stop sending at
+    :param stats:       Dictionary collecting latencies per kind, status counts and errors
+    """
+    await asyncio.sleep(max(start - time.perf_counter(), 0))
+    reader = writer = None
+    while time.perf_counter() < end:
+        kind = random.choices(kinds, weights)[0]
+        request = build_request(kind, port)
+        for attempt in range(2):
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('localhost', port)
+                sent = time.perf_counter()
+                writer.write(request)
+                status, close = await read_response(reader, request.startswith(b'HEAD'))
+                break
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError):
+                # The server closed the connection after the previous response, retry once on a new one
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                if attempt:
+                    stats['errors'] += 1
+                    status = None
+        if status is None:
+            continue
+        finished = time.perf_counter()
+        if finished >= warmup_end:
+            stats['latencies'].setdefault(kind, []).append(finished - sent)
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+        if close:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+def run_clients(args: tuple) -> dict:
+    """
+    Run a share of the clients on an asyncio loop in this process
+
+    :param args:        A tuple of the port, connections, mix, warmup and duration
+    :return:            The collected statistics
+    """
+    port, connections, mix, warmup, duration = args
+    kinds, weights = parse_mix(mix)
+    stats = {'latencies': dict(), 'status': dict(), 'errors': 0}
+    start = time.perf_counter() + 0.2
+    coroutines = [client(port, kinds, weights, start, start + warmup, start + warmup + duration, stats)
+                  for _ in range(connections)]
+
+    async def main():
+        await asyncio.gather(*coroutines)
+
+    asyncio.run(main())
+    return stats
+
+
+def percentile(ordered: list, q: float) -> float:
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000 if ordered else 0.0
+
+
+def summarize(latencies: list) -> dict:
+    ordered = sorted(latencies)
+    return {'count': len(ordered),
+            'mean_ms': sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+            'p50_ms': percentile(ordered, 0.5),
+            'p99_ms': percentile(ordered, 0.99),
+            'p999_ms': percentile(ordered, 0.999),
+            'max_ms': ordered[-1] * 1000 if ordered else 0.0}
+
+
+def start_server(port: int, server_args: list, content_dir: str) -> subprocess.Popen:
+    """
+    Start the server on a copy of the web directory and wait until it accepts connections
+
+    :param port:        The port to serve on
+    :param server_args: Extra command line arguments of the server
+    :param content_dir: Directory to run the server in, it gets a copy of HTTP_Server/web
+    :return:            The server process
+    """
+    shutil.copytree(os.path.join(SERVER_DIR, 'web'), os.path.join(content_dir, 'web'))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, SERVER_DIR]))
+    command = [sys.executable, os.path.join(SERVER_DIR, 'main.py'), '--port', str(port)] + server_args
+    server = subprocess.Popen(command, cwd=content_dir, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 0.2).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError('Server exited with code {code}'.format(code=server.returncode))
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('Server did not start listening on port {port}'.format(port=port))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load and latency benchmark for the HTTP server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--connections', type=int, default=100, help='concurrent keep-alive connections')
+    parser.add_argument('--processes', type=int, default=1, help='load generator processes sharing the connections')
+    parser.add_argument('--duration', type=float, default=10, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds before measuring starts')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='request mix as kind=weight pairs, kinds: '
+                                                           'get, head, ims (If-Modified-Since), 404, post, put')
+    parser.add_argument('--server-args', default='', help='extra arguments for HTTP_Server/main.py')
+    parser.add_argument('--output', default='bench_server.json', help='file to write the JSON results to')
+    args = parser.parse_args()
+    parse_mix(args.mix)  # Fail before starting the server
+
+    content_dir = tempfile.mkdtemp(prefix='bench_server_')
+    server = start_server(args.port, shlex.split(args.server_args), content_dir)
+    try:
+        shares = [args.connections // args.processes + (i < args.connections % args.processes)
+                  for i in range(args.processes)]
+        jobs = [(args.port, share, args.mix, args.warmup, args.duration) for share in shares if share]
+        if len(jobs) == 1:
+            results = [run_clients(jobs[0])]
+        else:
+            with multiprocessing.Pool(len(jobs)) as pool:
+                results = pool.map(run_clients, jobs)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(content_dir, ignore_errors=True)
+
+    per_kind, status, errors = dict(), dict(), 0
+    for result in results:
+        for kind, latencies in result['latencies'].items():
+            per_kind.setdefault(kind, []).extend(latencies)
+        for code, count in result['status'].items():
+            status[str(code)] = status.get(str(code), 0) + count
+        errors += result['errors']
+    everything = [latency for latencies in per_kind.values() for latency in latencies]
+    total = summarize(everything)
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'config': {'connections': args.connections, 'processes': args.processes, 'duration': args.duration,
+                   'warmup': args.warmup, 'mix': args.mix, 'server_args': args.server_args},
+        'requests_per_second': total['count'] / args.duration,
+        'latency': total,
+        'per_kind': {kind: summarize(latencies) for kind, latencies in sorted(per_kind.items())},
+        'status': status,
+        'errors': errors,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('{n} requests in {d:.1f} s: {rps:.0f} requests/s, {e} errors'.format(
+        n=total['count'], d=args.duration, rps=report['requests_per_second'], e=errors))
+    print('{kind:<6} {count:>8} {p50:>9} {p99:>9} {p999:>9}'.format(kind='kind', count='count', p50='p50 ms',
+                                                                   p99='p99 ms', p999='p99.9 ms'))
+    for kind, summary in [('all', total)] + sorted(report['per_kind'].items()):
+        print('{kind:<6} {count:>8} {p50_ms:>9.2f} {p99_ms:>9.2f} {p999_ms:>9.2f}'.format(kind=kind, **summary))
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
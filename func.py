@@ -1,3 +1,6 @@
+import re
+
+
 def parse_headers(resp: str, client=True, server=False) -> dict:
     """
     Parse the headers from an HTTP response
@@ -24,3 +27,292 @@ def parse_headers(resp: str, client=True, server=False) -> dict:
                 headers_dict.update({key: content})
         return headers_dict
 
+
+class ParseError(ValueError):
+    """
+    Raised when received data is not a valid HTTP message
+    """
+
+
+class Request(object):
+    """
+    A parsed HTTP request
+    """
+    __slots__ = ('method', 'target', 'version', 'headers', 'body', 'upload')
+
+    def __init__(self, method: str, target: str, version: str, headers: dict):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # Header names are title-cased, values are stripped
+        self.body = bytearray()
+        self.upload = None  # Object the body was written to instead of body, see RequestParser
+
+
+_HEX_DIGITS = re.compile(rb'[0-9A-Fa-f]+')
+_HEADER_NAMES = dict()  # Raw header names mapped to their title-cased form
+
+
+def parse_header_lines(lines: list) -> dict:
+    """
+    Parse header lines into a dictionary
+
+    :param lines:       The header lines, decoded as latin-1 and without line endings
+    :return:            A dictionary with title-cased header names and stripped values
+    """
+    headers_dict = dict()
+    for line in lines:
+        key, colon, content = line.partition(':')
+        if not colon:
+            raise ParseError('Malformed header line: {line!r}'.format(line=line))
+        name = _HEADER_NAMES.get(key)
+        if name is None:
+            name = key.strip().title()
+            if len(_HEADER_NAMES) < 512:  # Remember common names without letting clients grow the table
+                _HEADER_NAMES[key] = name
+        headers_dict[name] = content.strip()
+    return headers_dict
+
+
+class ChunkedDecoder(object):
+    """
+    Incremental decoder for the chunked transfer coding, working on a caller-owned buffer
+    """
+    SIZE, DATA, DATA_END, TRAILER, DONE = range(5)
+
+    def __init__(self, max_size_line: int = 4096, max_trailer_size: int = 64 * 1024):
+        """
+        :param max_size_line:       Maximum number of bytes of a chunk size line, extensions included
+        :param max_trailer_size:    Maximum number of bytes of the trailer section
+        """
+        self.state = ChunkedDecoder.SIZE
+        self.remaining = 0  # Bytes left in the current chunk
+        self.trailers = dict()
+        self.max_size_line = max_size_line
+        self.max_trailer_size = max_trailer_size
+        self._trailer_size = 0  # Bytes of the trailer lines decoded so far
+        self._scanned = 0  # Bytes of the current line already searched for its CRLF, counted from its start
+
+    def _find_line_end(self, buffer: bytearray, pos: int, limit: int) -> int:
+        """
+        Find the CRLF ending the line starting at pos, without searching bytes a previous call already searched
+
+        :param buffer:      The buffer holding the received bytes
+        :param pos:         Position of the start of the line
+        :param limit:       Maximum number of bytes of the line
+        :return:            The position of the CRLF, or -1 if it was not received yet
+        """
+        eol = buffer.find(b'\r\n', pos + max(self._scanned - 1, 0))  # The CR may have been the last byte searched
+        if eol < 0:
+            self._scanned = len(buffer) - pos
+            if self._scanned > limit:
+                raise ParseError('Line of the chunked body too long')
+            return -1
+        if eol - pos > limit:
+            raise ParseError('Line of the chunked body too long')
+        self._scanned = 0
+        return eol
+
+    @property
+    def done(self) -> bool:
+        return self.state == ChunkedDecoder.DONE
+
+    def decode(self, buffer: bytearray, pos: int) -> (list, int):
+        """
+        Decode as much of the buffer as possible, starting at pos
+
+        :param buffer:      The buffer holding the received bytes
+        :param pos:         Position of the first byte that was not decoded yet
+        :return:            A tuple of the decoded data pieces and the position after the consumed bytes
+        """
+        pieces = []
+        end = len(buffer)
+        while self.state != ChunkedDecoder.DONE:
+            if self.state == ChunkedDecoder.SIZE:
+                eol = self._find_line_end(buffer, pos, self.max_size_line)
+                if eol < 0:
+                    break
+                size_line = buffer[pos:eol].split(b';', 1)[0].strip()  # Ignore chunk extensions
+                if not _HEX_DIGITS.fullmatch(size_line):  # int() would also take signs, 0x and underscores
+                    raise ParseError('Invalid chunk size: {line!r}'.format(line=bytes(size_line)))
+                self.remaining = int(size_line, 16)
+                pos = eol + 2
+                self.state = ChunkedDecoder.DATA if self.remaining else ChunkedDecoder.TRAILER
+            elif self.state == ChunkedDecoder.DATA:
+                take = min(self.remaining, end - pos)
+                if take == 0:
+                    break
+                pieces.append(buffer[pos:pos + take])
+                pos += take
+                self.remaining -= take
+                if self.remaining == 0:
+                    self.state = ChunkedDecoder.DATA_END
+            elif self.state == ChunkedDecoder.DATA_END:
+                if end - pos < 2:
+                    break
+                if buffer[pos:pos + 2] != b'\r\n':
+                    raise ParseError('Chunk is not terminated by CRLF')
+                pos += 2
+                self.state = ChunkedDecoder.SIZE
+            else:  # Trailer section, ended by an empty line
+                eol = self._find_line_end(buffer, pos, self.max_trailer_size - self._trailer_size)
+                if eol < 0:
+                    break
+                self._trailer_size += eol + 2 - pos
+                if eol == pos:
+                    self.state = ChunkedDecoder.DONE
+                else:
+                    self.trailers.update(parse_header_lines([buffer[pos:eol].decode('latin-1')]))
+                pos = eol + 2
+        return pieces, pos
+
+
+class RequestParser(object):
+    """
+    Incremental HTTP request parser that resumes across partial reads and handles pipelined requests
+    """
+
+    def __init__(self, max_header_size: int = 64 * 1024, body_sink=None):
+        """
+        :param max_header_size: Maximum number of bytes of a request line and its headers
+        :param body_sink:       Function called with every request once its headers are parsed, returning an object
+                                with write() to stream the body to instead of keeping it in memory, or None
+        """
+        self.buffer = bytearray()  # Received bytes that were not consumed yet, reused between reads
+        self.max_header_size = max_header_size
+        self.body_sink = body_sink
+        self._scan_from = 0  # Where to resume searching for the end of the headers
+        self._request = None  # Request whose body is being received
+        self._body_remaining = 0
+        self._chunked = None
+        self._awaiting_continue = None  # Request that sent Expect: 100-continue and was not answered yet
+
+    def feed(self, data: bytes) -> list:
+        """
+        Add received bytes to the buffer and parse every request they complete
+
+        :param data:        The bytes received from the client
+        :return:            A list of the completed requests, in the order they were sent
+        """
+        self.buffer += data
+        requests = []
+        pos = 0
+        try:
+            while True:
+                if self._request is None:
+                    pos = self._parse_head(pos)
+                    if self._request is None:
+                        break
+                if self._body_remaining or self._chunked is not None:
+                    pos = self._parse_body(pos)
+                    if self._body_remaining or self._chunked is not None:
+                        break
+                requests.append(self._request)
+                self._request = None
+        except ParseError:
+            self.discard(requests)  # They are never handled, the connection is closed with a 400
+            raise
+        del self.buffer[:pos]  # Compact in place, keeping the allocation
+        self._scan_from = max(self._scan_from - pos, 0)
+        return requests
+
+    @property
+    def receiving_head(self) -> bool:
+        """
+        Whether part of a request line or its headers was received, but not all of it yet
+        """
+        return self._request is None and len(self.buffer) > 0
+
+    def abort(self):
+        """
+        Discard the request whose body is being received, for when the connection closes in the middle of it.
+        Its upload is told with abort() if it has that method.
+        """
+        if self._request is not None:
+            self.discard([self._request])
+        self._request = None
+        self._body_remaining = 0
+        self._chunked = None
+        self._awaiting_continue = None
+
+    def awaiting_continue(self):
+        """
+        Return the request whose body is being received if it sent Expect: 100-continue and waits to be told to send
+        its body. Every request is returned once, and not at all if its body arrived without waiting.
+
+        :return:            The request, or None
+        """
+        request, self._awaiting_continue = self._awaiting_continue, None
+        return request if request is self._request else None
+
+    @staticmethod
+    def discard(requests: list):
+        """
+        Abort the uploads of requests that will not be handled
+
+        :param requests:    The requests, whose uploads are told with abort() if they have that method
+        """
+        for request in requests:
+            if hasattr(request.upload, 'abort'):
+                request.upload.abort()
+
+    def _parse_head(self, pos: int) -> int:
+        """
+        Parse the request line and headers starting at pos, if they were fully received
+
+        :param pos:         Position of the first unconsumed byte
+        :return:            The position after the consumed bytes
+        """
+        while self.buffer.startswith(b'\r\n', pos):  # Ignore empty lines preceding a request
+            pos += 2
+        if self._scan_from < pos:
+            self._scan_from = pos
+        end = self.buffer.find(b'\r\n\r\n', self._scan_from)
+        if end < 0:
+            if len(self.buffer) - pos > self.max_header_size:
+                raise ParseError('Request headers too large')
+            self._scan_from = max(len(self.buffer) - 3, pos)  # Do not scan these bytes again
+            return pos
+        lines = self.buffer[pos:end].decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            raise ParseError('Malformed request line: {line!r}'.format(line=lines[0]))
+        self._request = Request(parts[0], parts[1], parts[2], parse_header_lines(lines[1:]))
+        headers = self._request.headers
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            self._chunked = ChunkedDecoder(max_trailer_size=self.max_header_size)
+        else:
+            length = headers.get('Content-Length', '0')
+            if not length.isdigit() or not length.isascii():  # Reject signs, underscores and other digits
+                raise ParseError('Invalid Content-Length: {value}'.format(value=length))
+            self._body_remaining = int(length)
+        if (self._chunked is not None or self._body_remaining) and self._request.version != 'HTTP/1.0' \
+                and headers.get('Expect', '').lower() == '100-continue':
+            self._awaiting_continue = self._request
+        if self.body_sink is not None:
+            self._request.upload = self.body_sink(self._request)
+        self._scan_from = end + 4
+        return end + 4
+
+    def _parse_body(self, pos: int) -> int:
+        """
+        Move the body bytes starting at pos into the current request or its upload
+
+        :param pos:         Position of the first unconsumed byte
+        :return:            The position after the consumed bytes
+        """
+        write = self._request.body.extend if self._request.upload is None else self._request.upload.write
+        if self._chunked is not None:
+            pieces, pos = self._chunked.decode(self.buffer, pos)
+            for piece in pieces:
+                write(piece)
+            if self._chunked.done:
+                self._request.headers.update(self._chunked.trailers)
+                self._chunked = None
+        elif self._body_remaining:
+            take = min(self._body_remaining, len(self.buffer) - pos)
+            write(self.buffer[pos:pos + take])
+            self._body_remaining -= take
+            pos += take
+        self._scan_from = max(self._scan_from, pos)
+        return pos
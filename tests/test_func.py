@@ -0,0 +1,96 @@
+"""
+Regression tests of the request parser and the chunked decoder in func.py
+
+Run from the repository root: python -m pytest -q tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from func import ChunkedDecoder, ParseError, RequestParser  # noqa: E402
+
+
+class ChunkedDecoderTest(unittest.TestCase):
+
+    def decode(self, data: bytes) -> bytes:
+        decoder = ChunkedDecoder()
+        pieces, pos = decoder.decode(bytearray(data), 0)
+        self.assertTrue(decoder.done)
+        self.assertEqual(pos, len(data))
+        return b''.join(pieces)
+
+    def test_chunks(self):
+        self.assertEqual(self.decode(b'5\r\nhello\r\nA;ext=1\r\n0123456789\r\n0\r\n\r\n'), b'hello0123456789')
+
+    def test_invalid_sizes(self):
+        for size in (b'-6', b'+5', b'1_0', b'0x3', b' ', b'', b'g'):
+            with self.subTest(size=size), self.assertRaises(ParseError):
+                ChunkedDecoder().decode(bytearray(size + b'\r\nhello!\r\n0\r\n\r\n'), 0)
+
+    def test_split_lines(self):
+        decoder = ChunkedDecoder()
+        buffer, pos, pieces = bytearray(), 0, []
+        for byte in b'5;ext=1\r\nhello\r\n0\r\nExpires: 0\r\n\r\n':
+            buffer.append(byte)
+            decoded, pos = decoder.decode(buffer, pos)
+            pieces += decoded
+        self.assertTrue(decoder.done)
+        self.assertEqual(b''.join(pieces), b'hello')
+        self.assertEqual(decoder.trailers, {'Expires': '0'})
+
+    def test_endless_size_line(self):
+        decoder = ChunkedDecoder(max_size_line=4096)
+        buffer = bytearray()
+        with self.assertRaises(ParseError):
+            for _ in range(10):
+                buffer += b'0' * 1024
+                decoder.decode(buffer, 0)
+        self.assertLess(len(buffer), 8 * 1024)
+
+    def test_endless_trailer(self):
+        decoder = ChunkedDecoder(max_trailer_size=1024)
+        with self.assertRaises(ParseError):
+            decoder.decode(bytearray(b'0\r\n' + b'X-Padding: 1\r\n' * 100), 0)
+
+
+class RequestParserTest(unittest.TestCase):
+
+    def test_pipelined_requests(self):
+        parser = RequestParser()
+        requests = parser.feed(b'POST /a HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\n\r\nhello'
+                               b'GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual([(request.method, request.target) for request in requests], [('POST', '/a'), ('GET', '/b')])
+        self.assertEqual(requests[0].body, b'hello')
+
+    def test_invalid_content_lengths(self):
+        for length in ('-17', '+5', '1_0', '0x3', '', '٣'):
+            with self.subTest(length=length), self.assertRaises(ParseError):
+                RequestParser().feed('POST /a HTTP/1.1\r\nHost: localhost\r\nContent-Length: {length}\r\n\r\n'
+                                     'GET /b HTTP/1.1\r\n\r\n'.format(length=length).encode('utf-8'))
+
+    def test_negative_chunk_size(self):
+        with self.assertRaises(ParseError):
+            RequestParser().feed(b'POST /a HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n'
+                                 b'-6\r\nhello!\r\n0\r\n\r\n')
+
+    def test_endless_chunk_size_line(self):
+        parser = RequestParser()
+        parser.feed(b'POST /a HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n')
+        with self.assertRaises(ParseError):
+            for _ in range(64):
+                parser.feed(b'0' * 1024)
+
+    def test_expect_continue(self):
+        parser = RequestParser()
+        head = b'PUT / HTTP/1.1\r\nHost: localhost\r\nExpect: 100-continue\r\nContent-Length: 5\r\n\r\n'
+        self.assertEqual(parser.feed(head), [])
+        self.assertEqual(parser.awaiting_continue().method, 'PUT')
+        self.assertIsNone(parser.awaiting_continue())  # Answered once
+        self.assertEqual(parser.feed(b'hello')[0].body, b'hello')
+        parser.feed(head + b'hello')
+        self.assertIsNone(parser.awaiting_continue())  # The body did not wait
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Tests of the request target normalization and file map in HTTP_Server/routing.py
+
+Run from the repository root: python -m pytest -q tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'HTTP_Server'))
+from routing import Router, normalize  # noqa: E402
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_clean_paths(self):
+        self.assertEqual(normalize('/index.html'), '/index.html')
+        self.assertEqual(normalize('/a/b.html?x=1'), '/a/b.html')
+        self.assertEqual(normalize('/a/'), '/a/')
+        self.assertEqual(normalize('/a%20b.png'), '/a b.png')
+
+    def test_dot_segments(self):
+        self.assertEqual(normalize('/a/./b/../c.html'), '/a/c.html')
+        self.assertEqual(normalize('//a//b.html'), '/a/b.html')
+        self.assertEqual(normalize('/a/..'), '/')
+
+    def test_absolute_form(self):
+        self.assertEqual(normalize('http://localhost:8000/a/b.html?x=1'), '/a/b.html')
+        with self.assertRaises(ValueError):
+            normalize('http://localhost/../x')
+
+    def test_traversal(self):
+        for target in ('/../x', '/%2e%2e/x', '/%2E%2E/x', '/a/../../x', '/a/%2e%2e/%2e%2e/x', '/..'):
+            with self.subTest(target=target), self.assertRaises(ValueError):
+                normalize(target)
+
+    def test_invalid_characters(self):
+        for target in ('/a%00.html', '/a\x00.html', '/a\\..\\x', '/a%5c..%5cx', 'index.html', '/%ff'):
+            with self.subTest(target=target), self.assertRaises(ValueError):
+                normalize(target)
+
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'a'))
+        for name in ('index.html', os.path.join('a', 'b.html'), '.hidden'):
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write('x')
+        self.router = Router(self.root, refresh_interval=0)
+        self.router.build()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_resolve(self):
+        self.assertEqual(self.router.resolve('/').path, self.root + '/index.html')
+        self.assertEqual(self.router.resolve('/a/b').path, self.root + '/a/b.html')
+        self.assertEqual(self.router.resolve('/a/../a/b.html').path, self.root + '/a/b.html')
+        self.assertIsNone(self.router.resolve('/missing.html'))
+        self.assertIsNone(self.router.resolve('/.hidden'))
+
+    def test_resolve_traversal(self):
+        for target in ('/../x', '/%2e%2e/x', '/a/../../x'):
+            with self.subTest(target=target), self.assertRaises(ValueError):
+                self.router.resolve(target)
+
+    def test_refresh(self):
+        with open(os.path.join(self.root, 'new.html'), 'w') as f:
+            f.write('x')
+        os.utime(self.root, (0, 0))  # Modification times may not change within the resolution of the clock
+        self.assertEqual(self.router.resolve('/new').path, self.root + '/new.html')
+
+
+if __name__ == '__main__':
+    unittest.main()
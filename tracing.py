@@ -0,0 +1,147 @@
+import functools
+import json
+import os
+import threading
+import time
+
+
+class _NoSpan(object):
+    """
+    Span returned while tracing is disabled, entering and leaving it does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class _Span(object):
+    """
+    A named phase being timed on the current thread
+    """
+    __slots__ = ('tracer', 'name', 'detail', 'parent', 'stack', 'start', 'children')
+
+    def __init__(self, tracer: 'Tracer', name: str, detail):
+        self.tracer = tracer
+        self.name = name
+        self.detail = detail
+        self.children = 0  # Nanoseconds spent in nested spans, subtracted for the self time of stacks
+
+    def __enter__(self) -> '_Span':
+        local = self.tracer._local
+        self.parent = getattr(local, 'span', None)
+        self.stack = self.name if self.parent is None else self.parent.stack + ';' + self.name
+        local.span = self
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        duration = end - self.start
+        self.tracer._local.span = self.parent
+        if self.parent is not None:
+            self.parent.children += duration
+        self.tracer._record(self, duration)
+        return False
+
+
+class Tracer(object):
+    """
+    Records how long named phases take, per thread and nested, and exports them as a Chrome trace or as folded
+    stacks for flame graphs. Disabled by default: span() then returns a span that does nothing, and instrument() is
+    only called once tracing is enabled, so instrumented functions run unchanged otherwise.
+    """
+
+    def __init__(self, max_events: int = 1000000):
+        """
+        :param max_events:  The maximum number of spans kept, later spans are counted in dropped
+        """
+        self.enabled = False
+        self.max_events = max_events
+        self.dropped = 0
+        self._events = []  # (name, start ns, duration ns, thread id, detail), appended from any thread
+        self._stacks = dict()  # Folded stack -> self time in ns
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+
+    def enable(self):
+        self._origin = time.perf_counter_ns()
+        self.enabled = True
+
+    def span(self, name: str, detail=None):
+        """
+        Time a phase, to be used as a context manager: with TRACER.span('parse'): ...
+
+        :param name:        The name of the phase
+        :param detail:      Optional value shown with the span in the trace viewer, e.g. the request target. Pass
+                            values that already exist, anything built for the call is built when disabled too
+        :return:            A context manager timing the phase
+        """
+        if not self.enabled:
+            return NO_SPAN
+        return _Span(self, name, detail)
+
+    def instrument(self, owner, attribute: str, name: str, detail=None):
+        """
+        Replace a function or method with one that records every call as a span. Unlike span() this costs nothing
+        while tracing is disabled, as the original function is only replaced once it is enabled.
+
+        :param owner:       The object, class or module holding the function
+        :param attribute:   The name of the function
+        :param name:        The name of the spans
+        :param detail:      Optional function of the arguments of a call returning the detail of its span, it is
+                            passed self too when the function is replaced on a class
+        """
+        function = getattr(owner, attribute)
+        if getattr(function, 'traced', False):
+            return  # Already instrumented, e.g. by another server in the same process
+
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            with self.span(name, None if detail is None else detail(*args, **kwargs)):
+                return function(*args, **kwargs)
+
+        traced.traced = True
+        setattr(owner, attribute, traced)
+
+    def _record(self, span: _Span, duration: int):
+        with self._lock:
+            self._stacks[span.stack] = self._stacks.get(span.stack, 0) + duration - span.children
+            if len(self._events) < self.max_events:
+                self._events.append((span.name, span.start, duration, threading.get_ident(), span.detail))
+            else:
+                self.dropped += 1
+
+    def write(self, path: str):
+        """
+        Write the recorded spans to a file, a Chrome trace-event file (chrome://tracing, Perfetto) if the path
+        ends with .json, folded stacks otherwise (flamegraph.pl, speedscope), which contain self times in µs.
+        Spans beyond max_events are still counted in the stacks, the trace-event file reports how many it lacks.
+
+        :param path:        The file to write
+        """
+        with self._lock:
+            events, stacks, dropped = list(self._events), dict(self._stacks), self.dropped
+        if path.endswith('.json'):
+            pid = os.getpid()
+            trace = [{'name': name, 'ph': 'X', 'ts': (start - self._origin) / 1000, 'dur': duration / 1000,
+                      'pid': pid, 'tid': tid, 'args': {} if detail is None else {'detail': str(detail)}}
+                     for name, start, duration, tid, detail in events]
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': {'dropped_spans': dropped}}, f)
+            if dropped:
+                print('{path} lacks the {n} spans recorded after the first {max}'.format(path=path, n=dropped,
+                                                                                        max=self.max_events))
+        else:
+            with open(path, 'w') as f:
+                for stack, self_time in sorted(stacks.items()):
+                    f.write('{stack} {us}\n'.format(stack=stack, us=self_time // 1000))
+
+
+TRACER = Tracer()  # Shared by the code of a process, enabled with the --trace option of the client and server